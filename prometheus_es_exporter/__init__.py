@@ -7,13 +7,20 @@ import json
 import logging
 import os
 import sched
+import threading
 import time
 
+from collections import OrderedDict
 from elasticsearch import Elasticsearch, RequestsHttpConnection
-from elasticsearch.exceptions import ConnectionTimeout
+from elasticsearch.exceptions import ConnectionTimeout, HTTP_EXCEPTIONS, TransportError
 from jog import JogFormatter
-from prometheus_client import start_http_server
+from prometheus_client import Counter, start_http_server
 from prometheus_client.core import GaugeMetricFamily, REGISTRY
+try:
+    # Requires the elasticsearch async extra (i.e. aiohttp).
+    from elasticsearch import AsyncElasticsearch
+except ImportError:
+    AsyncElasticsearch = None
 try:
     from requests_aws4auth import AWS4Auth
     from botocore.session import Session
@@ -25,10 +32,21 @@ from . import indices_aliases_parser
 from . import indices_mappings_parser
 from . import indices_stats_parser
 from . import nodes_stats_parser
-from .metrics import (group_metrics, gauge_generator,
+from .async_scheduler import PrioritySemaphore, run_jobs
+from .breaker import CircuitBreaker
+from .collectors import (BackgroundCollector, BreakerCollector, CoalescingCollector,
+                         FormatCacheCollector, ParallelCollector, ThrottleCollector,
+                         collector_up_gauge)
+from .exposition import start_cached_http_server
+from .metrics import (SeriesLimitExceeded, group_metrics, gauge_generator,
                       format_metric_name, merge_metric_dicts)
-from .parser import parse_response
-from .scheduler import schedule_job
+from .parser import (next_composite_query, parse_aggregations,
+                     parse_response, set_composite_page_size)
+from .path_filter import PathFilter, to_filter_path
+from .ratelimit import AsyncRateLimitedTransport, RateLimitedTransport, TokenBucket
+from .scheduler import DEFAULT_PRIORITY, PriorityExecutor, schedule_job, stagger_offset
+from .serializers import get_serializer
+from .throttle import SearchThrottle
 from .utils import log_exceptions, nice_shutdown
 
 log = logging.getLogger(__name__)
@@ -38,29 +56,58 @@ CONTEXT_SETTINGS = {
 }
 
 METRICS_BY_QUERY = {}
+# Incremented whenever METRICS_BY_QUERY is updated.
+METRICS_BY_QUERY_GENERATION = 0
+METRICS_BY_QUERY_LOCK = threading.Lock()
+
+# Circuit breakers for queries that have them configured, by query name.
+BREAKERS_BY_QUERY = {}
 
+SERIES_TRUNCATED = Counter('es_exporter_series_truncated',
+                           'Number of times metrics were truncated by a series limit.',
+                           ['name'])
 
-def collector_up_gauge(name_list, description, succeeded=True):
-    metric_name = format_metric_name(*name_list, 'up')
-    description = 'Did the {} fetch succeed.'.format(description)
-    return GaugeMetricFamily(metric_name, description, value=int(succeeded))
+
+def set_query_metrics(query_name, metric_dict):
+    global METRICS_BY_QUERY_GENERATION
+
+    with METRICS_BY_QUERY_LOCK:
+        METRICS_BY_QUERY[query_name] = metric_dict
+        METRICS_BY_QUERY_GENERATION += 1
+
+
+def group_metrics_limited(metrics, name, max_series=None, metric_dict=None):
+    """
+    Groups metrics, truncating them if they exceed `max_series` series.
+
+    Returns a tuple of (metric dict, whether the metrics were truncated).
+    """
+    try:
+        return group_metrics(metrics, metric_dict=metric_dict, max_series=max_series), False
+    except SeriesLimitExceeded as e:
+        log.warning('Metrics for %(name)s exceeded the limit of %(max_series)s series, truncating.',
+                    {'name': name, 'max_series': max_series})
+        SERIES_TRUNCATED.labels(name).inc()
+        return e.metric_dict, True
 
 
 class ClusterHealthCollector(object):
-    def __init__(self, es_client, timeout, level):
+    def __init__(self, es_client, timeout, level, max_series=None):
         self.metric_name_list = ['es', 'cluster_health']
         self.description = 'Cluster Health'
 
         self.es_client = es_client
         self.timeout = timeout
         self.level = level
+        self.max_series = max_series
 
     def collect(self):
         try:
             response = self.es_client.cluster.health(level=self.level, request_timeout=self.timeout)
 
             metrics = cluster_health_parser.parse_response(response, self.metric_name_list)
-            metric_dict = group_metrics(metrics)
+            metric_dict, _ = group_metrics_limited(metrics, format_metric_name(*self.metric_name_list),
+                                                   self.max_series)
         except ConnectionTimeout:
             log.warning('Timeout while fetching %(description)s (timeout %(timeout_s)ss).',
                         {'description': self.description, 'timeout_s': self.timeout})
@@ -75,20 +122,37 @@ class ClusterHealthCollector(object):
 
 
 class NodesStatsCollector(object):
-    def __init__(self, es_client, timeout, metrics=None):
+    def __init__(self, es_client, timeout, metrics=None, paths=None, max_series=None):
         self.metric_name_list = ['es', 'nodes_stats']
         self.description = 'Nodes Stats'
 
         self.es_client = es_client
         self.timeout = timeout
         self.metrics = metrics
+        self.max_series = max_series
+
+        self.path_filter = None
+        self.filter_path = None
+        if paths:
+            self.path_filter = PathFilter.compile(paths)
+            # Node and bucket names are needed for labels, even if they aren't selected.
+            self.filter_path = to_filter_path(paths, 'nodes.*',
+                                              required=['_nodes.failed', 'nodes.*.name'],
+                                              bucket_list_keys=nodes_stats_parser.bucket_list_keys)
 
     def collect(self):
         try:
-            response = self.es_client.nodes.stats(metric=self.metrics, request_timeout=self.timeout)
-
-            metrics = nodes_stats_parser.parse_response(response, self.metric_name_list)
-            metric_dict = group_metrics(metrics)
+            response = self.es_client.nodes.stats(metric=self.metrics,
+                                                  filter_path=self.filter_path,
+                                                  request_timeout=self.timeout)
+
+            metrics = nodes_stats_parser.parse_response(response, self.metric_name_list,
+                                                        path_filter=self.path_filter)
+            metric_dict, _ = group_metrics_limited(metrics, format_metric_name(*self.metric_name_list),
+                                                   self.max_series)
+            # Metrics are parsed lazily as they're grouped, so the response can be
+            # released before the gauges are generated.
+            del response, metrics
         except ConnectionTimeout:
             log.warning('Timeout while fetching %(description)s (timeout %(timeout_s)ss).',
                         {'description': self.description, 'timeout_s': self.timeout})
@@ -103,19 +167,21 @@ class NodesStatsCollector(object):
 
 
 class IndicesAliasesCollector(object):
-    def __init__(self, es_client, timeout):
+    def __init__(self, es_client, timeout, max_series=None):
         self.metric_name_list = ['es', 'indices_aliases']
         self.description = 'Indices Aliases'
 
         self.es_client = es_client
         self.timeout = timeout
+        self.max_series = max_series
 
     def collect(self):
         try:
             response = self.es_client.indices.get_alias(request_timeout=self.timeout)
 
             metrics = indices_aliases_parser.parse_response(response, self.metric_name_list)
-            metric_dict = group_metrics(metrics)
+            metric_dict, _ = group_metrics_limited(metrics, format_metric_name(*self.metric_name_list),
+                                                   self.max_series)
         except ConnectionTimeout:
             log.warning('Timeout while fetching %(description)s (timeout %(timeout_s)ss).',
                         {'description': self.description, 'timeout_s': self.timeout})
@@ -129,20 +195,94 @@ class IndicesAliasesCollector(object):
             yield collector_up_gauge(self.metric_name_list, self.description)
 
 
+# Maximum number of indices to fetch mappings for in a single request, when
+# fetching incrementally.
+INDICES_MAPPINGS_BATCH_SIZE = 100
+
+
 class IndicesMappingsCollector(object):
-    def __init__(self, es_client, timeout):
+    def __init__(self, es_client, timeout, incremental=False, max_series=None):
         self.metric_name_list = ['es', 'indices_mappings']
         self.description = 'Indices Mappings'
 
         self.es_client = es_client
         self.timeout = timeout
+        self.incremental = incremental
+        self.max_series = max_series
+        # Maps index -> ((index UUID, mapping version), field counts), when fetching
+        # incrementally. The UUID distinguishes indices recreated with the same name.
+        # Field counts are None for indices with no mappings returned (e.g. closed indices).
+        self.index_counts = {}
+
+    def fetch_counts(self):
+        """
+        Fetches field counts for indices with changed mappings.
+
+        Index UUIDs and mapping versions are checked in the cluster state
+        metadata, and only indices with new versions (or without versions, in
+        Elasticsearch versions that don't track them) have their mappings
+        fetched.
+        """
+        response = self.es_client.cluster.state(metric='metadata',
+                                                filter_path=['metadata.indices.*.mapping_version',
+                                                             'metadata.indices.*.settings.index.uuid'],
+                                                request_timeout=self.timeout)
+        versions = {}
+        for index, data in response.get('metadata', {}).get('indices', {}).items():
+            mapping_version = data.get('mapping_version')
+            uuid = data.get('settings', {}).get('index', {}).get('uuid')
+            versions[index] = (uuid, mapping_version) if mapping_version is not None else None
+
+        index_counts = {
+            index: self.index_counts[index]
+            for index, version in versions.items()
+            if index in self.index_counts
+            and version is not None
+            and self.index_counts[index][0] == version
+        }
+        changed = [index for index in versions if index not in index_counts]
+
+        if not index_counts:
+            # Nothing cached, so fetch everything in a single request.
+            responses = [self.es_client.indices.get_mapping(request_timeout=self.timeout)]
+        else:
+            responses = [
+                self.es_client.indices.get_mapping(
+                    index=changed[i:i + INDICES_MAPPINGS_BATCH_SIZE],
+                    ignore_unavailable=True,
+                    request_timeout=self.timeout)
+                for i in range(0, len(changed), INDICES_MAPPINGS_BATCH_SIZE)
+            ]
+
+        for index in changed:
+            index_counts[index] = (versions[index], None)
+        for response in responses:
+            for index, data in response.items():
+                # Skip indices that were created after the versions were fetched.
+                if index in versions:
+                    counts = indices_mappings_parser.count_index_fields(data['mappings'])
+                    index_counts[index] = (versions[index], counts)
+
+        self.index_counts = index_counts
+
+        return {
+            index: counts
+            for index, (_, counts) in index_counts.items()
+            if counts is not None
+        }
 
     def collect(self):
         try:
-            response = self.es_client.indices.get_mapping(request_timeout=self.timeout)
+            if self.incremental:
+                counts_by_index = self.fetch_counts()
+                metrics = indices_mappings_parser.parse_counts(counts_by_index,
+                                                               self.metric_name_list)
+            else:
+                response = self.es_client.indices.get_mapping(request_timeout=self.timeout)
+                metrics = indices_mappings_parser.parse_response(response, self.metric_name_list)
 
-            metrics = indices_mappings_parser.parse_response(response, self.metric_name_list)
-            metric_dict = group_metrics(metrics)
+            metric_dict, _ = group_metrics_limited(metrics, format_metric_name(*self.metric_name_list),
+                                                   self.max_series)
         except ConnectionTimeout:
             log.warning('Timeout while fetching %(description)s (timeout %(timeout_s)ss).',
                         {'description': self.description, 'timeout_s': self.timeout})
@@ -158,7 +298,8 @@ class IndicesMappingsCollector(object):
 
 class IndicesStatsCollector(object):
     def __init__(self, es_client, timeout, parse_indices=False,
-                 indices=None, metrics=None, fields=None):
+                 indices=None, metrics=None, fields=None,
+                 batch_size=None, batch_workers=1, max_series=None):
         self.metric_name_list = ['es', 'indices_stats']
         self.description = 'Indices Stats'
 
@@ -168,18 +309,119 @@ class IndicesStatsCollector(object):
         self.indices = indices
         self.metrics = metrics
         self.fields = fields
+        self.batch_size = batch_size
+        self.max_series = max_series
+
+        self.request_params = indices_stats_parser.plan_request(parse_indices, metrics)
+        log.debug('Planned %(description)s request params: %(request_params)s.',
+                  {'description': self.description, 'request_params': self.request_params})
+        # Whether the size saved by the planned request still needs logging.
+        self.log_plan_size = True
+
+        self.executor = None
+        if batch_size:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=batch_workers)
+
+    def fetch_stats(self, indices, **params):
+        return self.es_client.indices.stats(index=indices,
+                                            metric=self.metrics,
+                                            fields=self.fields,
+                                            request_timeout=self.timeout,
+                                            **self.request_params,
+                                            **params)
+
+    def log_plan_savings(self, response):
+        """
+        Logs the size of a planned response, compared to an unplanned one.
+
+        The client only exposes decoded responses, so sizes are of the
+        responses re-encoded as compact JSON. This fetches the unplanned
+        response (which may be large), so is only done once, when debug
+        logging is enabled. Errors are logged, rather than failing the
+        collect.
+        """
+        self.log_plan_size = False
+        if not log.isEnabledFor(logging.DEBUG):
+            return
+
+        try:
+            unplanned_response = self.es_client.indices.stats(index=self.indices,
+                                                              metric=self.metrics,
+                                                              fields=self.fields,
+                                                              request_timeout=self.timeout)
+        except Exception:
+            log.exception('Error while fetching unplanned %(description)s, to log its size.',
+                          {'description': self.description})
+            return
+
+        planned_size = len(json.dumps(response, separators=(',', ':')))
+        unplanned_size = len(json.dumps(unplanned_response, separators=(',', ':')))
+        log.debug('Planned %(description)s response is %(planned)s bytes, compared to '
+                  '%(unplanned)s bytes unplanned (%(saved)s bytes saved).',
+                  {'description': self.description, 'planned': planned_size,
+                   'unplanned': unplanned_size, 'saved': unplanned_size - planned_size})
+
+    def collect_batches(self):
+        """
+        Fetches stats for the indices in batches, concurrently.
+
+        Metrics are returned for every batch that succeeds, even if others fail.
+        Returns a tuple of (metric dict, number of batches, number of failed batches).
+        """
+        index_names = list(self.es_client.indices.get_alias(index=self.indices,
+                                                            expand_wildcards='open',
+                                                            request_timeout=self.timeout))
+        batches = [index_names[i:i + self.batch_size]
+                   for i in range(0, len(index_names), self.batch_size)]
+
+        # Indices may be closed or deleted between listing them and fetching
+        # their stats, which shouldn't fail the whole batch.
+        futures = [self.executor.submit(self.fetch_stats, batch, ignore_unavailable=True)
+                   for batch in batches]
+
+        metric_dict = {}
+        failed = 0
+        truncated = False
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                response = future.result()
+            except ConnectionTimeout:
+                log.warning('Timeout while fetching %(description)s batch (timeout %(timeout_s)ss).',
+                            {'description': self.description, 'timeout_s': self.timeout})
+                failed += 1
+            except Exception:
+                log.exception('Error while fetching %(description)s batch.',
+                              {'description': self.description})
+                failed += 1
+            else:
+                # Once the series limit is reached, later batches are dropped.
+                if not truncated:
+                    metrics = indices_stats_parser.parse_response(response,
+                                                                  self.parse_indices,
+                                                                  self.metric_name_list)
+                    metric_dict, truncated = group_metrics_limited(
+                        metrics, format_metric_name(*self.metric_name_list),
+                        self.max_series, metric_dict=metric_dict)
+                    del metrics
+                del response
+
+        return metric_dict, len(batches), failed
 
     def collect(self):
         try:
-            response = self.es_client.indices.stats(index=self.indices,
-                                                    metric=self.metrics,
-                                                    fields=self.fields,
-                                                    request_timeout=self.timeout)
-
-            metrics = indices_stats_parser.parse_response(response,
-                                                          self.parse_indices,
-                                                          self.metric_name_list)
-            metric_dict = group_metrics(metrics)
+            if self.batch_size:
+                metric_dict, batches, failed_batches = self.collect_batches()
+            else:
+                response = self.fetch_stats(self.indices)
+                if self.log_plan_size:
+                    self.log_plan_savings(response)
+
+                metrics = indices_stats_parser.parse_response(response,
+                                                              self.parse_indices,
+                                                              self.metric_name_list)
+                metric_dict, _ = group_metrics_limited(metrics, format_metric_name(*self.metric_name_list),
+                                                       self.max_series)
+                del response, metrics
         except ConnectionTimeout:
             log.warning('Timeout while fetching %(description)s (timeout %(timeout_s)ss).',
                         {'description': self.description, 'timeout_s': self.timeout})
@@ -190,12 +432,26 @@ class IndicesStatsCollector(object):
             yield collector_up_gauge(self.metric_name_list, self.description, succeeded=False)
         else:
             yield from gauge_generator(metric_dict)
-            yield collector_up_gauge(self.metric_name_list, self.description)
+            if self.batch_size:
+                yield GaugeMetricFamily(format_metric_name(*self.metric_name_list, 'batches'),
+                                        'Number of {} batches fetched.'.format(self.description),
+                                        value=batches)
+                yield GaugeMetricFamily(format_metric_name(*self.metric_name_list, 'batches', 'failed'),
+                                        'Number of {} batches that failed.'.format(self.description),
+                                        value=failed_batches)
+                yield collector_up_gauge(self.metric_name_list, self.description,
+                                         succeeded=not failed_batches)
+            else:
+                yield collector_up_gauge(self.metric_name_list, self.description)
 
 
 class QueryMetricCollector(object):
 
-    def collect(self):
+    @property
+    def generation(self):
+        return METRICS_BY_QUERY_GENERATION
+
+    def collect_cached(self):
         # Copy METRICS_BY_QUERY before iterating over it
         # as it may be updated by other threads.
         # (only first level - lower levels are replaced
@@ -204,68 +460,318 @@ class QueryMetricCollector(object):
         for metric_dict in query_metrics.values():
             yield from gauge_generator(metric_dict)
 
+    def collect_uncached(self):
+        return iter(())
+
+    def collect(self):
+        return self.collect_cached()
+
+
+def query_steps(query_name, query, max_series=None):
+    """
+    Runs a query, independent of how its requests are made.
+
+    A generator that yields search bodies to request, and must be sent each
+    response in turn. This lets the threaded and asyncio engines share the
+    query logic.
+
+    It returns (via StopIteration) a (metric dict, took) tuple, where took is
+    the total time Elasticsearch spent on the query's searches in seconds, or
+    None if the search timed out.
+    """
+    response = yield query
+    if response['timed_out']:
+        # Later pages can't be combined with a page that has no results.
+        return {}, None
+    took = response['took'] / 1000
+
+    metrics = parse_response(response, [query_name])
+    metric_dict, truncated = group_metrics_limited(metrics, query_name, max_series)
+
+    # Fetch the remaining pages of any top level composite aggregations,
+    # adding their metrics to the first page's.
+    next_query = next_composite_query(query, response)
+    while next_query is not None and not truncated:
+        response = yield next_query
+        if response['timed_out']:
+            raise RuntimeError('Composite aggregation page timed out.')
+        took += response['took'] / 1000
+
+        metrics = parse_aggregations(response.get('aggregations', {}), [query_name])
+        metric_dict, truncated = group_metrics_limited(metrics, query_name, max_series,
+                                                       metric_dict=metric_dict)
+
+        next_query = next_composite_query(next_query, response)
+
+    return metric_dict, took
+
+
+def query_allowed(query_name):
+    """
+    Checks the query's circuit breaker (if it has one) allows it to run.
+    """
+    breaker = BREAKERS_BY_QUERY.get(query_name)
+    if breaker is None or breaker.allow():
+        return True
+
+    log.debug('Skipping query %(query_name)s, as its circuit breaker is open.',
+              {'query_name': query_name})
+    return False
+
+
+def handle_query_error(es_client, e, query_name, indices, query, on_error):
+    log.exception('Error while querying indices %(indices)s, query %(query)s.',
+                  {'indices': indices, 'query': query})
+
+    # Recorded first, as some errors are re-raised.
+    breaker = BREAKERS_BY_QUERY.get(query_name)
+    if breaker is not None:
+        breaker.record_failure()
+
+    # NOTE(mjozefcz): If there is 401/403 http error, and the AWS signing was
+    # set, re-raise it and exit the exporter. It might be wrongly-configured
+    # credentials or old session.
+    try:
+        if e.status_code in [401, 403] and type(es_client.transport.kwargs.get("http_auth")) is AWS4Auth:
+            # TODO (mjozefcz): Consider re-initialization of AWS4AUTH if possible.
+            raise e
+    except (AttributeError, NameError):
+        pass
+
+    # If this query has successfully run before, we need to handle any
+    # metrics produced by that previous run.
+    if query_name in METRICS_BY_QUERY:
+        old_metric_dict = METRICS_BY_QUERY[query_name]
+
+        if on_error == 'preserve':
+            metric_dict = old_metric_dict
+
+        elif on_error == 'drop':
+            metric_dict = {}
+
+        elif on_error == 'zero':
+            # Merging the old metric dict with an empty one, and zeroing
+            # any missing metrics, produces a metric dict with the same
+            # metrics, but all zero values.
+            metric_dict = merge_metric_dicts(old_metric_dict, {},
+                                             zero_missing=True)
+
+        set_query_metrics(query_name, metric_dict)
+
+
+def handle_query_metrics(query_name, metric_dict, took, on_missing):
+    # If this query has successfully run before, we need to handle any
+    # missing metrics.
+    if query_name in METRICS_BY_QUERY:
+        old_metric_dict = METRICS_BY_QUERY[query_name]
+
+        if on_missing == 'preserve':
+            metric_dict = merge_metric_dicts(old_metric_dict, metric_dict,
+                                             zero_missing=False)
+
+        elif on_missing == 'drop':
+            pass  # use new metric dict untouched
+
+        elif on_missing == 'zero':
+            metric_dict = merge_metric_dicts(old_metric_dict, metric_dict,
+                                             zero_missing=True)
+
+    set_query_metrics(query_name, metric_dict)
+
+    breaker = BREAKERS_BY_QUERY.get(query_name)
+    if breaker is not None:
+        breaker.record_success(took)
 
-def run_query(es_client, query_name, indices, query,
-              timeout, on_error, on_missing):
 
+def run_steps(steps, request):
+    """
+    Runs request steps (e.g. from query_steps()) to completion.
+
+    Each body the steps yield is requested with request(body). The response
+    is sent back to the steps, or if the request fails, the exception is
+    thrown into them. Returns the steps' return value.
+    """
     try:
-        response = es_client.search(index=indices, body=query, request_timeout=timeout)
+        body = next(steps)
+        while True:
+            try:
+                response = request(body)
+            except Exception as e:
+                body = steps.throw(e)
+            else:
+                body = steps.send(response)
+    except StopIteration as stop:
+        return stop.value
+
+
+async def run_steps_async(steps, request):
+    """
+    Like run_steps(), but request(body) returns an awaitable.
+    """
+    try:
+        body = next(steps)
+        while True:
+            try:
+                response = await request(body)
+            except Exception as e:
+                body = steps.throw(e)
+            else:
+                body = steps.send(response)
+    except StopIteration as stop:
+        return stop.value
+
+
+def run_query_steps(es_client, query_name, indices, query,
+                    timeout, on_error, on_missing, max_series=None):
+    """
+    Runs a query (see query_steps()), and handles its result or error.
+
+    Shared by run_query() and run_query_async().
+    """
+    if not query_allowed(query_name):
+        return
 
-        metrics = parse_response(response, [query_name])
-        metric_dict = group_metrics(metrics)
+    try:
+        metric_dict, took = yield from query_steps(query_name, query, max_series=max_series)
 
     except Exception as e:
-        log.exception('Error while querying indices %(indices)s, query %(query)s.',
-                      {'indices': indices, 'query': query})
+        handle_query_error(es_client, e, query_name, indices, query, on_error)
+
+    else:
+        handle_query_metrics(query_name, metric_dict, took, on_missing)
+
+
+def run_query(es_client, query_name, indices, query,
+              timeout, on_error, on_missing, max_series=None):
+    steps = run_query_steps(es_client, query_name, indices, query,
+                            timeout, on_error, on_missing, max_series)
+    run_steps(steps, lambda body: es_client.search(index=indices, body=body,
+                                                   request_timeout=timeout))
+
+
+async def run_query_async(es_client, query_name, indices, query,
+                          timeout, on_error, on_missing, max_series=None):
+    """
+    Like run_query(), but with an AsyncElasticsearch client.
+    """
+    steps = run_query_steps(es_client, query_name, indices, query,
+                            timeout, on_error, on_missing, max_series)
+    await run_steps_async(steps, lambda body: es_client.search(index=indices, body=body,
+                                                               request_timeout=timeout))
+
+
+def msearch_item_error(item):
+    """
+    Builds an exception for a failed search in a multi search response.
+    """
+    status = item.get('status', 'N/A')
+    error = item['error']
+    error_type = error.get('type') if isinstance(error, dict) else error
+    return HTTP_EXCEPTIONS.get(status, TransportError)(status, error_type, item)
+
+
+def query_batch_steps(es_client, batch):
+    """
+    Runs a batch of queries together, using multi search requests.
+
+    Takes the batch as a list of run_query() argument tuples (without the
+    client). Like query_steps(), a generator that yields multi search bodies,
+    and must be sent each response in turn (or thrown the exception if the
+    request fails). Each query's result is handled independently, as if it
+    were run by run_query(). Queries that need more requests (e.g. more
+    composite aggregation pages) are batched together again.
+    """
+    # Tuples of (run_query() args, query steps, next search body).
+    pending = []
+    for args in batch:
+        query_name, indices, query, timeout, on_error, on_missing, max_series = args
+        if not query_allowed(query_name):
+            continue
+        steps = query_steps(query_name, query, max_series=max_series)
+        pending.append((args, steps, next(steps)))
+
+    while pending:
+        body = []
+        for args, _, search_body in pending:
+            body.append({'index': args[1]})
+            body.append(search_body)
 
-        # NOTE(mjozefcz): If there is 401/403 http error, and the AWS signing was
-        # set, re-raise it and exit the exporter. It might be wrongly-configured
-        # credentials or old session.
         try:
-            if e.status_code in [401, 403] and type(es_client.transport.kwargs.get("http_auth")) is AWS4Auth:
-                # TODO (mjozefcz): Consider re-initialization of AWS4AUTH if possible.
-                raise e
-        except NameError:
-            pass
+            response = yield body
+        except Exception as e:
+            for args, _, _ in pending:
+                query_name, indices, query, timeout, on_error, on_missing, _ = args
+                handle_query_error(es_client, e, query_name, indices, query, on_error)
+            return
 
-        # If this query has successfully run before, we need to handle any
-        # metrics produced by that previous run.
-        if query_name in METRICS_BY_QUERY:
-            old_metric_dict = METRICS_BY_QUERY[query_name]
+        next_pending = []
+        for (args, steps, _), item in zip(pending, response['responses']):
+            query_name, indices, query, timeout, on_error, on_missing, _ = args
+            try:
+                if 'error' in item:
+                    raise msearch_item_error(item)
+                search_body = steps.send(item)
+            except StopIteration as stop:
+                metric_dict, took = stop.value
+                handle_query_metrics(query_name, metric_dict, took, on_missing)
+            except Exception as e:
+                handle_query_error(es_client, e, query_name, indices, query, on_error)
+            else:
+                next_pending.append((args, steps, search_body))
 
-            if on_error == 'preserve':
-                metric_dict = old_metric_dict
+        pending = next_pending
 
-            elif on_error == 'drop':
-                metric_dict = {}
 
-            elif on_error == 'zero':
-                # Merging the old metric dict with an empty one, and zeroing
-                # any missing metrics, produces a metric dict with the same
-                # metrics, but all zero values.
-                metric_dict = merge_metric_dicts(old_metric_dict, {},
-                                                 zero_missing=True)
+def batch_timeout(batch):
+    # The batch can take as long as its slowest query is allowed to.
+    return max(args[3] for args in batch)
 
-            METRICS_BY_QUERY[query_name] = metric_dict
 
-    else:
-        # If this query has successfully run before, we need to handle any
-        # missing metrics.
-        if query_name in METRICS_BY_QUERY:
-            old_metric_dict = METRICS_BY_QUERY[query_name]
+def run_query_batch(es_client, batch):
+    """
+    Runs a batch of queries with multi search requests (see query_batch_steps()).
+    """
+    timeout = batch_timeout(batch)
+    steps = query_batch_steps(es_client, batch)
+    run_steps(steps, lambda body: es_client.msearch(body=body, request_timeout=timeout))
 
-            if on_missing == 'preserve':
-                metric_dict = merge_metric_dicts(old_metric_dict, metric_dict,
-                                                 zero_missing=False)
 
-            elif on_missing == 'drop':
-                pass  # use new metric dict untouched
+async def run_query_batch_async(es_client, batch):
+    """
+    Like run_query_batch(), but with an AsyncElasticsearch client.
+    """
+    timeout = batch_timeout(batch)
+    steps = query_batch_steps(es_client, batch)
+    await run_steps_async(steps, lambda body: es_client.msearch(body=body,
+                                                                request_timeout=timeout))
 
-            elif on_missing == 'zero':
-                metric_dict = merge_metric_dicts(old_metric_dict, metric_dict,
-                                                 zero_missing=True)
 
-        METRICS_BY_QUERY[query_name] = metric_dict
+def batch_queries(queries, batch_size):
+    """
+    Groups queries with the same interval and priority into batches of up to
+    batch_size.
+
+    Takes queries as a dict of query name -> query config tuple. Returns a list
+    of (interval, priority, deadline, batch) tuples, where batches are lists
+    of run_query() argument tuples (without the client). A batch's deadline is
+    the earliest of its queries' deadlines.
+    """
+    grouped = OrderedDict()
+    for query_name, (interval, timeout, indices, query, on_error, on_missing,
+                     max_series, priority, deadline) in queries.items():
+        grouped.setdefault((interval, priority), []).append(
+            ((query_name, indices, query, timeout, on_error, on_missing, max_series),
+             deadline))
+
+    batches = []
+    for (interval, priority), group in grouped.items():
+        for i in range(0, len(group), batch_size):
+            batch = group[i:i + batch_size]
+            deadlines = [deadline for _, deadline in batch if deadline is not None]
+            batches.append((interval, priority, min(deadlines) if deadlines else None,
+                            [args for args, _ in batch]))
+
+    return batches
 
 
 # Based on click.Choice
@@ -362,6 +868,13 @@ INDICES_STATS_METRICS_OPTIONS = [
 ]
 
 
+def nodes_stats_paths_parser(ctx, param, value):
+    if value is None:
+        return None
+
+    return [path for path in value.split(',') if path]
+
+
 def indices_stats_indices_parser(ctx, param, value):
     if value is None:
         return None
@@ -454,8 +967,16 @@ CONFIGPARSER_CONVERTERS = {
                    'Header name and value should be separated by colon, e.g. '
                    '"Authorization: Bearer xxxxx". Several headers can be added '
                    'by repeating the -H parameter.')
+@click.option('--json-serializer', default='auto',
+              type=click.Choice(['auto', 'orjson', 'ujson', 'json']),
+              help='JSON library used to decode Elasticsearch responses. '
+                   'auto uses the fastest installed library. (default: auto)')
 @click.option('--port', '-p', default=9206,
               help='Port to serve the metrics endpoint on. (default: 9206)')
+@click.option('--exposition-cache', default=False, is_flag=True,
+              help='Cache the rendered (and gzip compressed) output of query metrics and '
+                   'background fetched cluster metrics between metrics endpoint calls, '
+                   'only re-rendering it when the metrics change.')
 @click.option('--query-disable', default=False, is_flag=True,
               help='Disable query monitoring. '
                    'No config files/queries need to be present if query monitoring is disabled.')
@@ -474,10 +995,75 @@ CONFIGPARSER_CONVERTERS = {
 @click.option('--threads', type=click.IntRange(min=1), default=1,
               help='Enables concurrent query execution using the number of threads specified. '
                    '(default: 1)')
+@click.option('--query-stagger/--no-query-stagger', default=True,
+              help='Spread the first runs of queries (or query batches) across their '
+                   'intervals, rather than starting them all at once. Offsets are based on '
+                   'query names, so are the same between restarts. (default: enabled)')
+@click.option('--query-jitter', type=click.FloatRange(min=0), default=0,
+              help='Delay each query run by a random amount of up to N seconds, to further '
+                   'spread load. (default: 0)')
+@click.option('--query-max-concurrent-runs', type=click.IntRange(min=1), default=1,
+              help='Maximum number of runs of a query (or query batch) in progress at once. '
+                   'If a query is still running this many times when it is next due, that '
+                   'run is skipped. (default: 1)')
+@click.option('--query-batch-size', type=click.IntRange(min=2),
+              help='Run queries with the same interval together, in multi search requests '
+                   'of up to this many queries. The results of each query are handled '
+                   'separately. If not specified, each query is run in its own request.')
+@click.option('--query-engine', default='threads',
+              type=click.Choice(['threads', 'asyncio']),
+              help='How queries are run. threads runs them on the --threads thread pool. '
+                   'asyncio runs them all concurrently on a single event loop, and requires '
+                   'the elasticsearch async extra (aiohttp) to be installed. (default: threads)')
+@click.option('--query-max-in-flight', type=click.IntRange(min=1),
+              help='Maximum number of queries in progress at once with the asyncio query '
+                   'engine. Further query runs wait for one to finish. '
+                   'If not specified, there is no limit.')
+@click.option('--query-throttle-interval', type=click.FloatRange(min=0),
+              help='Poll the search thread pool stats of the cluster every N seconds, and scale '
+                   'the number of queries run at once to them. The limit is halved while '
+                   'searches are queueing (see --query-throttle-max-queue) or being rejected, '
+                   'and otherwise increased by one, up to --threads (or --query-max-in-flight '
+                   'with the asyncio query engine). If not specified, queries are not throttled.')
+@click.option('--query-throttle-max-queue', type=click.IntRange(min=0), default=10,
+              help='The longest search queue on any node considered quiet when throttling '
+                   'queries. (default: 10)')
+@click.option('--query-throttle-timeout', default=5.0,
+              help='Request timeout for search thread pool stats, in seconds. (default: 5)')
+@click.option('--query-rate-limit', type=click.FloatRange(min=0),
+              help='Maximum rate of query requests to Elasticsearch, per second. Further '
+                   'requests wait their turn. If not specified, there is no limit.')
+@click.option('--query-rate-burst', type=click.IntRange(min=1),
+              help='Number of query requests that can be made at once before '
+                   '--query-rate-limit applies. (default: the rate limit, or 1)')
+@click.option('--collectors-parallel', default=False, is_flag=True,
+              help='Fetch cluster health, nodes stats, indices aliases, indices mappings, '
+                   'and indices stats concurrently when the metrics endpoint is called, '
+                   'rather than one after another.')
+@click.option('--collectors-coalesce-window', default=0.0,
+              help='Reuse the result of fetching cluster health, nodes stats, etc. for '
+                   'metrics endpoint calls made within this many seconds of the fetch completing. '
+                   'Calls made while a fetch is in progress always share its result. '
+                   '(default: 0)')
+@click.option('--collectors-rate-limit', type=click.FloatRange(min=0),
+              help='Maximum rate of requests to Elasticsearch for cluster health, nodes stats, '
+                   'etc., per second. Further requests wait their turn. '
+                   'If not specified, there is no limit.')
+@click.option('--collectors-rate-burst', type=click.IntRange(min=1),
+              help='Number of collector requests that can be made at once before '
+                   '--collectors-rate-limit applies. (default: the rate limit, or 1)')
 @click.option('--cluster-health-disable', default=False, is_flag=True,
               help='Disable cluster health monitoring.')
 @click.option('--cluster-health-timeout', default=10.0,
               help='Request timeout for cluster health monitoring, in seconds. (default: 10)')
+@click.option('--cluster-health-max-series', type=int,
+              help='Maximum number of series to produce from cluster health. Further series are '
+                   'dropped, and es_exporter_series_truncated_total is incremented. '
+                   'If not specified, there is no limit.')
+@click.option('--cluster-health-interval', type=float,
+              help='Fetch cluster health in the background every N seconds, and serve the '
+                   'cached result when the metrics endpoint is called. '
+                   'If not specified, it is fetched whenever the metrics endpoint is called.')
 @click.option('--cluster-health-level', default='indices',
               type=click.Choice(['cluster', 'indices', 'shards']),
               help='Level of detail for cluster health monitoring.  (default: indices)')
@@ -485,22 +1071,65 @@ CONFIGPARSER_CONVERTERS = {
               help='Disable nodes stats monitoring.')
 @click.option('--nodes-stats-timeout', default=10.0,
               help='Request timeout for nodes stats monitoring, in seconds. (default: 10)')
+@click.option('--nodes-stats-max-series', type=int,
+              help='Maximum number of series to produce from nodes stats. Further series are '
+                   'dropped, and es_exporter_series_truncated_total is incremented. '
+                   'If not specified, there is no limit.')
+@click.option('--nodes-stats-interval', type=float,
+              help='Fetch nodes stats in the background every N seconds, and serve the '
+                   'cached result when the metrics endpoint is called. '
+                   'If not specified, it is fetched whenever the metrics endpoint is called.')
 @click.option('--nodes-stats-metrics',
               type=MultiChoice(NODES_STATS_METRICS_OPTIONS),
               help='Limit nodes stats to specific metrics. '
                    'Metrics should be separated by commas e.g. indices,fs.')
+@click.option('--nodes-stats-paths',
+              callback=nodes_stats_paths_parser,
+              help='Limit nodes stats to specific paths through each node\'s stats. '
+                   'Paths should be separated by commas, with keys in a path separated by dots. '
+                   '"*" matches any key, e.g. jvm.mem,thread_pool.*.rejected. '
+                   'Prefix a path with "!" to exclude it, e.g. !indices.segments. '
+                   'Included paths are also used to filter the response in Elasticsearch.')
 @click.option('--indices-aliases-disable', default=False, is_flag=True,
               help='Disable indices aliases monitoring.')
 @click.option('--indices-aliases-timeout', default=10.0,
               help='Request timeout for indices aliases monitoring, in seconds. (default: 10)')
+@click.option('--indices-aliases-max-series', type=int,
+              help='Maximum number of series to produce from indices aliases. Further series are '
+                   'dropped, and es_exporter_series_truncated_total is incremented. '
+                   'If not specified, there is no limit.')
+@click.option('--indices-aliases-interval', type=float,
+              help='Fetch indices aliases in the background every N seconds, and serve the '
+                   'cached result when the metrics endpoint is called. '
+                   'If not specified, it is fetched whenever the metrics endpoint is called.')
 @click.option('--indices-mappings-disable', default=False, is_flag=True,
               help='Disable indices mappings monitoring.')
 @click.option('--indices-mappings-timeout', default=10.0,
               help='Request timeout for indices mappings monitoring, in seconds. (default: 10)')
+@click.option('--indices-mappings-max-series', type=int,
+              help='Maximum number of series to produce from indices mappings. Further series are '
+                   'dropped, and es_exporter_series_truncated_total is incremented. '
+                   'If not specified, there is no limit.')
+@click.option('--indices-mappings-interval', type=float,
+              help='Fetch indices mappings in the background every N seconds, and serve the '
+                   'cached result when the metrics endpoint is called. '
+                   'If not specified, it is fetched whenever the metrics endpoint is called.')
+@click.option('--indices-mappings-incremental', default=False, is_flag=True,
+              help='Only fetch the mappings of indices whose mappings have changed since '
+                   'the last fetch, based on the mapping versions in the cluster state. '
+                   'Field counts for unchanged indices are reused.')
 @click.option('--indices-stats-disable', default=False, is_flag=True,
               help='Disable indices stats monitoring.')
 @click.option('--indices-stats-timeout', default=10.0,
               help='Request timeout for indices stats monitoring, in seconds. (default: 10)')
+@click.option('--indices-stats-max-series', type=int,
+              help='Maximum number of series to produce from indices stats. Further series are '
+                   'dropped, and es_exporter_series_truncated_total is incremented. '
+                   'If not specified, there is no limit.')
+@click.option('--indices-stats-interval', type=float,
+              help='Fetch indices stats in the background every N seconds, and serve the '
+                   'cached result when the metrics endpoint is called. '
+                   'If not specified, it is fetched whenever the metrics endpoint is called.')
 @click.option('--indices-stats-mode', default='cluster',
               type=click.Choice(['cluster', 'indices']),
               help='Detail mode for indices stats monitoring. (default: cluster)')
@@ -509,6 +1138,14 @@ CONFIGPARSER_CONVERTERS = {
               help='Limit indices stats to specific indices. '
                    'Only takes effect if "--indices-stats-mode=indices". '
                    'Indices should be separated by commas e.g. index1,index2.')
+@click.option('--indices-stats-batch-size', type=click.IntRange(min=1),
+              help='Fetch indices stats for this many indices per request, rather than '
+                   'for all indices in a single request. '
+                   'Metrics are still produced for successful batches if others fail. '
+                   'Only takes effect if "--indices-stats-mode=indices".')
+@click.option('--indices-stats-batch-workers', type=click.IntRange(min=1), default=4,
+              help='Maximum number of indices stats batches to fetch concurrently. '
+                   '(default: 4)')
 @click.option('--indices-stats-metrics',
               type=MultiChoice(INDICES_STATS_METRICS_OPTIONS),
               help='Limit indices stats to specific metrics. '
@@ -557,10 +1194,40 @@ def cli(**options):
                                    '--indices-stats-mode must be "indices" for '
                                    '--indices-stats-indices to be used.')
 
+    if options['indices_stats_batch_size'] and options['indices_stats_mode'] != 'indices':
+        raise click.BadOptionUsage('indices_stats_batch_size',
+                                   '--indices-stats-mode must be "indices" for '
+                                   '--indices-stats-batch-size to be used.')
+
+    query_async = options['query_engine'] == 'asyncio'
+    if query_async and AsyncElasticsearch is None:
+        raise click.BadOptionUsage('query_engine',
+                                   'The asyncio query engine requires the elasticsearch '
+                                   'async extra (aiohttp) to be installed.')
+    if query_async and options['aws_sign_request']:
+        raise click.BadOptionUsage('query_engine',
+                                   'AWS request signing is not supported by the asyncio '
+                                   'query engine.')
+
     executor = None
     num_threads = options['threads']
     if num_threads > 1:
-        executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads)
+        executor = PriorityExecutor(max_workers=num_threads)
+
+    semaphore = None
+    if options['query_max_in_flight']:
+        semaphore = PrioritySemaphore(options['query_max_in_flight'])
+
+    if options['query_throttle_interval']:
+        if query_async and semaphore is None:
+            raise click.BadOptionUsage('query_throttle_interval',
+                                       '--query-max-in-flight must be set for '
+                                       '--query-throttle-interval to be used with the '
+                                       'asyncio query engine.')
+        if not query_async and executor is None:
+            raise click.BadOptionUsage('query_throttle_interval',
+                                       '--threads must be more than 1 for '
+                                       '--query-throttle-interval to be used.')
 
     log_handler = logging.StreamHandler()
     log_format = '[%(asctime)s] %(name)s.%(levelname)s %(threadName)s %(message)s'
@@ -605,9 +1272,35 @@ def cli(**options):
             "client_key": options['client_key']
         })
 
-    es_client = Elasticsearch(es_cluster, **kwargs)
-
-    scheduler = None
+    try:
+        serializer = get_serializer(options['json_serializer'])
+    except ValueError as e:
+        raise click.BadOptionUsage('json_serializer', str(e))
+    log.info('Decoding responses with %(serializer)s.', {'serializer': serializer.name})
+    kwargs['serializer'] = serializer
+
+    # Queries and collectors use separate clients, so their requests can be
+    # rate limited separately.
+    query_limiter = None
+    if options['query_rate_limit']:
+        query_limiter = TokenBucket('query', options['query_rate_limit'],
+                                    options['query_rate_burst'])
+    collectors_limiter = None
+    if options['collectors_rate_limit']:
+        collectors_limiter = TokenBucket('collectors', options['collectors_rate_limit'],
+                                         options['collectors_rate_burst'])
+
+    es_client = Elasticsearch(es_cluster, transport_class=RateLimitedTransport,
+                              rate_limiter=collectors_limiter, **kwargs)
+    query_es_client = Elasticsearch(es_cluster, transport_class=RateLimitedTransport,
+                                    rate_limiter=query_limiter, **kwargs)
+
+    scheduler = sched.scheduler()
+    # Tuples of (coroutine function, args, run_periodically() kwargs), for the
+    # asyncio query engine.
+    async_jobs = []
+    # Set if query concurrency is throttled.
+    throttle = None
 
     if not options['query_disable']:
         config = configparser.ConfigParser(converters=CONFIGPARSER_CONVERTERS)
@@ -629,61 +1322,209 @@ def cli(**options):
                 indices = config.get(section, 'QueryIndices',
                                      fallback='_all')
                 query = json.loads(config.get(section, 'QueryJson'))
+                composite_page_size = config.getint(section, 'QueryCompositePageSize',
+                                                    fallback=None)
+                max_series = config.getint(section, 'QueryMaxSeries',
+                                           fallback=None)
+                breaker_failures = config.getint(section, 'QueryBreakerFailures',
+                                                 fallback=None)
+                breaker_slow = config.getfloat(section, 'QueryBreakerSlowSecs',
+                                               fallback=None)
+                breaker_max_interval = config.getfloat(section, 'QueryBreakerMaxIntervalSecs',
+                                                       fallback=None)
+                priority = config.getint(section, 'QueryPriority',
+                                         fallback=DEFAULT_PRIORITY)
+                deadline = config.getfloat(section, 'QueryDeadlineSecs',
+                                           fallback=None)
                 on_error = config.getenum(section, 'QueryOnError',
                                           fallback='drop')
                 on_missing = config.getenum(section, 'QueryOnMissing',
                                             fallback='drop')
 
-                queries[query_name] = (interval, timeout, indices, query,
-                                       on_error, on_missing)
-
-        scheduler = sched.scheduler()
-
-        if queries:
-            for query_name, (interval, timeout, indices, query,
-                             on_error, on_missing) in queries.items():
-                schedule_job(scheduler, executor, interval,
-                             run_query, es_client, query_name, indices, query,
-                             timeout, on_error, on_missing)
+                if composite_page_size:
+                    query = set_composite_page_size(query, composite_page_size)
+
+                if breaker_failures:
+                    BREAKERS_BY_QUERY[query_name] = CircuitBreaker(
+                        query_name, interval,
+                        failure_threshold=breaker_failures,
+                        slow_secs=breaker_slow,
+                        max_interval=breaker_max_interval)
+
+                queries[query_name] = (interval, timeout, indices, query, on_error, on_missing,
+                                       max_series, priority, deadline)
+
+        def query_job_kwargs(name, interval, priority, deadline):
+            offset = 0
+            if options['query_stagger']:
+                offset = stagger_offset(name, interval)
+
+            return {
+                'offset': offset,
+                'jitter': options['query_jitter'],
+                'name': name,
+                'max_concurrent_runs': options['query_max_concurrent_runs'],
+                'priority': priority,
+                'deadline': deadline,
+            }
+
+        if query_async and queries:
+            async_es_client = AsyncElasticsearch(es_cluster,
+                                                 transport_class=AsyncRateLimitedTransport,
+                                                 rate_limiter=query_limiter, **kwargs)
+
+        if queries and options['query_batch_size']:
+            batches = batch_queries(queries, options['query_batch_size'])
+            for interval, priority, deadline, batch in batches:
+                # Batches are named after their first query.
+                job_kwargs = query_job_kwargs(batch[0][0], interval, priority, deadline)
+                if query_async:
+                    async_jobs.append((run_query_batch_async, (async_es_client, batch),
+                                       dict(job_kwargs, interval=interval)))
+                else:
+                    schedule_job(scheduler, executor, interval,
+                                 run_query_batch, query_es_client, batch,
+                                 **job_kwargs)
+        elif queries:
+            for query_name, (interval, timeout, indices, query, on_error, on_missing,
+                             max_series, priority, deadline) in queries.items():
+                job_kwargs = query_job_kwargs(query_name, interval, priority, deadline)
+                if query_async:
+                    async_jobs.append((run_query_async,
+                                       (async_es_client, query_name, indices, query,
+                                        timeout, on_error, on_missing, max_series),
+                                       dict(job_kwargs, interval=interval)))
+                else:
+                    schedule_job(scheduler, executor, interval,
+                                 run_query, query_es_client, query_name, indices, query,
+                                 timeout, on_error, on_missing, max_series,
+                                 **job_kwargs)
         else:
             log.error('No queries found in config file(s)')
             return
 
+        throttle_interval = options['query_throttle_interval']
+        if throttle_interval:
+            if query_async:
+                throttle = SearchThrottle(semaphore, options['query_max_in_flight'],
+                                          max_queue=options['query_throttle_max_queue'],
+                                          timeout=options['query_throttle_timeout'])
+                # Polls don't wait for the queries they throttle.
+                async_jobs.append((throttle.poll_async, (async_es_client,),
+                                   {'interval': throttle_interval, 'name': 'query_throttle',
+                                    'max_concurrent_runs': 1, 'semaphore': None}))
+            else:
+                throttle = SearchThrottle(executor, num_threads,
+                                          max_queue=options['query_throttle_max_queue'],
+                                          timeout=options['query_throttle_timeout'])
+                # Polls are run on their own thread, so they don't wait for the
+                # queries they throttle, or hold up the scheduler. Like the
+                # asyncio engine's, they count against the query rate limit.
+                throttle_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                schedule_job(scheduler, throttle_executor, throttle_interval,
+                             throttle.poll, query_es_client,
+                             name='query_throttle', max_concurrent_runs=1)
+
+    # Tuples of (collector, background refresh interval).
+    collectors = []
+
     if not options['cluster_health_disable']:
-        REGISTRY.register(ClusterHealthCollector(es_client,
-                                                 options['cluster_health_timeout'],
-                                                 options['cluster_health_level']))
+        collectors.append((ClusterHealthCollector(es_client,
+                                                  options['cluster_health_timeout'],
+                                                  options['cluster_health_level'],
+                                                  max_series=options['cluster_health_max_series']),
+                           options['cluster_health_interval']))
 
     if not options['nodes_stats_disable']:
-        REGISTRY.register(NodesStatsCollector(es_client,
-                                              options['nodes_stats_timeout'],
-                                              metrics=options['nodes_stats_metrics']))
+        collectors.append((NodesStatsCollector(es_client,
+                                               options['nodes_stats_timeout'],
+                                               metrics=options['nodes_stats_metrics'],
+                                               paths=options['nodes_stats_paths'],
+                                               max_series=options['nodes_stats_max_series']),
+                           options['nodes_stats_interval']))
 
     if not options['indices_aliases_disable']:
-        REGISTRY.register(IndicesAliasesCollector(es_client,
-                                                  options['indices_aliases_timeout']))
+        collectors.append((IndicesAliasesCollector(es_client,
+                                                   options['indices_aliases_timeout'],
+                                                   max_series=options['indices_aliases_max_series']),
+                           options['indices_aliases_interval']))
 
     if not options['indices_mappings_disable']:
-        REGISTRY.register(IndicesMappingsCollector(es_client,
-                                                   options['indices_mappings_timeout']))
+        collectors.append((IndicesMappingsCollector(es_client,
+                                                    options['indices_mappings_timeout'],
+                                                    incremental=options['indices_mappings_incremental'],
+                                                    max_series=options['indices_mappings_max_series']),
+                           options['indices_mappings_interval']))
 
     if not options['indices_stats_disable']:
         parse_indices = options['indices_stats_mode'] == 'indices'
-        REGISTRY.register(IndicesStatsCollector(es_client,
-                                                options['indices_stats_timeout'],
-                                                parse_indices=parse_indices,
-                                                indices=options['indices_stats_indices'],
-                                                metrics=options['indices_stats_metrics'],
-                                                fields=options['indices_stats_fields']))
+        collectors.append((IndicesStatsCollector(es_client,
+                                                 options['indices_stats_timeout'],
+                                                 parse_indices=parse_indices,
+                                                 indices=options['indices_stats_indices'],
+                                                 metrics=options['indices_stats_metrics'],
+                                                 fields=options['indices_stats_fields'],
+                                                 batch_size=options['indices_stats_batch_size'],
+                                                 batch_workers=options['indices_stats_batch_workers'],
+                                                 max_series=options['indices_stats_max_series']),
+                           options['indices_stats_interval']))
+
+    # Collectors served by the metrics endpoint.
+    exporter_collectors = []
+    # Collectors that are fetched whenever the metrics endpoint is called.
+    scrape_collectors = []
+
+    # Background refreshes run on their own threads, so they don't hold up
+    # the scheduler or wait for (or count against the limit of) queries.
+    background_count = sum(1 for _, interval in collectors if interval)
+    if background_count:
+        background_executor = concurrent.futures.ThreadPoolExecutor(max_workers=background_count)
+
+    for collector, interval in collectors:
+        if interval:
+            collector = BackgroundCollector(collector)
+            # A refresh is skipped if the last one is still in progress.
+            schedule_job(scheduler, background_executor, interval, collector.refresh,
+                         name=format_metric_name(*collector.metric_name_list),
+                         max_concurrent_runs=1)
+            exporter_collectors.append(collector)
+        else:
+            scrape_collectors.append(
+                CoalescingCollector(collector, window=options['collectors_coalesce_window']))
+
+    if options['collectors_parallel'] and len(scrape_collectors) > 1:
+        exporter_collectors.append(ParallelCollector(scrape_collectors))
+    else:
+        exporter_collectors.extend(scrape_collectors)
+
+    if not options['query_disable']:
+        exporter_collectors.append(QueryMetricCollector())
 
-    if scheduler:
-        REGISTRY.register(QueryMetricCollector())
+    REGISTRY.register(FormatCacheCollector())
+    if BREAKERS_BY_QUERY:
+        REGISTRY.register(BreakerCollector(BREAKERS_BY_QUERY))
+    if throttle is not None:
+        REGISTRY.register(ThrottleCollector(throttle))
 
     log.info('Starting server...')
-    start_http_server(port)
+    if options['exposition_cache']:
+        # The registry is left with just the default process etc. collectors,
+        # which are served alongside the exporter collectors.
+        start_cached_http_server(port, [REGISTRY] + exporter_collectors)
+    else:
+        for collector in exporter_collectors:
+            REGISTRY.register(collector)
+        start_http_server(port)
     log.info('Server started on port %(port)s', {'port': port})
 
-    if scheduler:
+    if async_jobs:
+        if not scheduler.empty():
+            # Background collectors still use the scheduler.
+            scheduler_thread = threading.Thread(target=scheduler.run)
+            scheduler_thread.daemon = True
+            scheduler_thread.start()
+        run_jobs(async_jobs, semaphore=semaphore)
+    elif not scheduler.empty():
         scheduler.run()
     else:
         while True:
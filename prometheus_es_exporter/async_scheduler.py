@@ -0,0 +1,158 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+
+from .scheduler import DEFAULT_PRIORITY, JOB_OVERRUNS, JOB_RUNS_EXPIRED, JOB_RUNS_SKIPPED
+
+log = logging.getLogger(__name__)
+
+
+class PrioritySemaphore(object):
+    """
+    Like asyncio.Semaphore, but waiters acquire it lowest priority first, then
+    earliest deadline first.
+
+    The number of holders allowed at once can be changed with set_limit().
+    """
+
+    def __init__(self, value):
+        self.limit = value
+        self.held = 0
+        # Heap of (priority, deadline, sequence, future).
+        self.waiters = []
+        self.sequence = itertools.count()
+
+    async def acquire(self, priority=DEFAULT_PRIORITY, deadline=None):
+        if self.held < self.limit and not self.waiters:
+            self.held += 1
+            return
+
+        if deadline is None:
+            deadline = float('inf')
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiters, (priority, deadline, next(self.sequence), future))
+        # The slot is taken on this waiter's behalf when it's woken.
+        await future
+
+    def release(self):
+        self.held -= 1
+        self.wake()
+
+    def set_limit(self, limit):
+        """
+        Sets the number of holders allowed at once. Existing holders keep it.
+        """
+        self.limit = max(1, limit)
+        self.wake()
+
+    def wake(self):
+        while self.held < self.limit and self.waiters:
+            _, _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                self.held += 1
+                future.set_result(None)
+
+
+async def run_job(semaphore, name, priority, deadline_time, func, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+
+    if semaphore is not None:
+        await semaphore.acquire(priority, deadline_time)
+    try:
+        if deadline_time is not None and loop.time() > deadline_time:
+            log.debug('Dropping run of job %(name)s, as it missed its deadline.', {'name': name})
+            if name is not None:
+                JOB_RUNS_EXPIRED.labels(name).inc()
+            return
+
+        await func(*args, **kwargs)
+    except Exception:
+        log.exception('Error while running scheduled job.')
+    finally:
+        if semaphore is not None:
+            semaphore.release()
+
+
+async def run_periodically(interval, func, *args, semaphore=None, offset=0, jitter=0,
+                           name=None, max_concurrent_runs=None,
+                           priority=DEFAULT_PRIORITY, deadline=None, **kwargs):
+    """
+    Run a coroutine function on a fixed interval, forever.
+
+    Like schedule_job(), runs are started on the interval whether or not
+    previous runs have finished (unless `max_concurrent_runs` are still in
+    progress), and are delayed by the offset and jitter. If a semaphore is
+    given, each run holds it while in progress. Runs waiting for the semaphore
+    are ordered by priority, and dropped if they can't start within `deadline`
+    seconds of being due (including any jitter).
+    """
+    loop = asyncio.get_event_loop()
+    running = 0
+
+    async def run(run_time):
+        nonlocal running
+
+        deadline_time = None
+        if deadline is not None:
+            deadline_time = run_time + deadline
+
+        start_time = loop.time()
+        try:
+            await run_job(semaphore, name, priority, deadline_time, func, *args, **kwargs)
+        finally:
+            running -= 1
+            if name is not None and loop.time() - start_time > interval:
+                JOB_OVERRUNS.labels(name).inc()
+
+    next_scheduled_time = loop.time() + offset
+    await asyncio.sleep(offset)
+    while True:
+        # Deadlines are measured from after the jitter.
+        run_time = next_scheduled_time
+        if jitter:
+            delay = random.uniform(0, jitter)
+            run_time += delay
+            await asyncio.sleep(delay)
+
+        if max_concurrent_runs is not None and running >= max_concurrent_runs:
+            log.debug('Skipping run of job %(name)s, as %(running)s runs are still in progress.',
+                      {'name': name, 'running': running})
+            if name is not None:
+                JOB_RUNS_SKIPPED.labels(name).inc()
+        else:
+            running += 1
+            asyncio.ensure_future(run(run_time))
+
+        current_time = loop.time()
+        next_scheduled_time += interval
+        while next_scheduled_time < current_time:
+            next_scheduled_time += interval
+
+        await asyncio.sleep(next_scheduled_time - current_time)
+
+
+def run_jobs(jobs, semaphore=None, **job_kwargs):
+    """
+    Run jobs on their intervals on an asyncio event loop, forever.
+
+    Takes jobs as a list of (coroutine function, args, kwargs) tuples, where
+    kwargs are run_periodically() keyword arguments (including the interval).
+    Keyword arguments passed to run_jobs() apply to every job.
+
+    If a PrioritySemaphore is given, it limits the number of runs (of any job)
+    in progress at once, unless a job sets its own semaphore (e.g. None).
+    Further runs wait for one to finish, in priority order.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    for func, args, kwargs in jobs:
+        kwargs = dict(job_kwargs, **kwargs)
+        kwargs.setdefault('semaphore', semaphore)
+        interval = kwargs.pop('interval')
+        asyncio.ensure_future(run_periodically(interval, func, *args, **kwargs))
+
+    loop.run_forever()
@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+STATES = (CLOSED, OPEN, HALF_OPEN)
+
+
+class CircuitBreaker(object):
+    """
+    Backs off a job's interval while it's failing.
+
+    Runs are allowed while the breaker is closed. After `failure_threshold`
+    consecutive failures (or runs slower than `slow_secs`, if set), it opens,
+    and runs are skipped for double the job's interval. The next run is then
+    allowed as a probe (half-open). If the probe succeeds the breaker closes,
+    otherwise it opens again with the interval doubled, up to `max_interval`.
+
+    The job keeps its schedule; skipped runs just don't make any requests.
+    allow() should be called before each run, and record_success() or
+    record_failure() after it. Times are taken from `clock`.
+    """
+
+    def __init__(self, name, interval, failure_threshold=1, slow_secs=None, max_interval=None,
+                 clock=time.monotonic):
+        self.name = name
+        self.clock = clock
+        self.base_interval = interval
+        self.failure_threshold = failure_threshold
+        self.slow_secs = slow_secs
+        self.max_interval = max_interval if max_interval is not None else interval * 16
+
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        # The effective interval between runs.
+        self.interval = interval
+        self.last_allowed_time = clock()
+        self.retry_time = None
+
+    def allow(self):
+        with self.lock:
+            now = self.clock()
+            if self.state == OPEN:
+                # Runs are only attempted on the job's schedule (give or take
+                # jitter), so allow a probe up to half an interval early.
+                if now < self.retry_time - self.base_interval / 2:
+                    return False
+
+                log.info('Probing %(name)s after backing off for %(interval)s seconds.',
+                         {'name': self.name, 'interval': self.interval})
+                self.state = HALF_OPEN
+
+            elif self.state == HALF_OPEN:
+                # Only one probe at a time.
+                return False
+
+            self.last_allowed_time = now
+            return True
+
+    def record_success(self, took):
+        """
+        Records a successful run, that took `took` seconds (or None if it timed
+        out, which counts as a failure).
+        """
+        if took is None or (self.slow_secs is not None and took > self.slow_secs):
+            self.record_failure()
+            return
+
+        with self.lock:
+            if self.state != CLOSED:
+                log.info('Closing circuit breaker for %(name)s.', {'name': self.name})
+
+            self.state = CLOSED
+            self.failures = 0
+            self.interval = self.base_interval
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+
+            if self.state == HALF_OPEN:
+                self.interval = min(self.interval * 2, self.max_interval)
+            elif self.state == CLOSED and self.failures >= self.failure_threshold:
+                self.interval = min(self.base_interval * 2, self.max_interval)
+            else:
+                return
+
+            log.warning('Opening circuit breaker for %(name)s after %(failures)s failures, '
+                        'backing off for %(interval)s seconds.',
+                        {'name': self.name, 'failures': self.failures, 'interval': self.interval})
+            self.state = OPEN
+            self.retry_time = self.last_allowed_time + self.interval
@@ -0,0 +1,214 @@
+import concurrent.futures
+import threading
+import time
+
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from .breaker import STATES
+from .metrics import format_label_key, format_metric_name
+
+
+def collector_up_gauge(name_list, description, succeeded=True):
+    metric_name = format_metric_name(*name_list, 'up')
+    description = 'Did the {} fetch succeed.'.format(description)
+    return GaugeMetricFamily(metric_name, description, value=int(succeeded))
+
+
+def collector_cache_age_gauge(name_list, description, age):
+    metric_name = format_metric_name(*name_list, 'cache', 'age', 'seconds')
+    description = 'Age of the cached {} result, in seconds.'.format(description)
+    return GaugeMetricFamily(metric_name, description, value=age)
+
+
+class BackgroundCollector(object):
+    """
+    Serves the last result of a wrapped collector, refreshed in the background.
+
+    refresh() should be run periodically (e.g. scheduled with schedule_job()).
+    collect() only returns the cached result of the last refresh, so scrapes
+    never wait on Elasticsearch.
+
+    The generation attribute is incremented whenever the cached result changes.
+    """
+
+    def __init__(self, collector, clock=time.monotonic):
+        self.metric_name_list = collector.metric_name_list
+        self.description = collector.description
+
+        self.collector = collector
+        self.clock = clock
+        # Tuple of (metric families, refresh time), replaced wholesale on
+        # refresh so it can be read safely from other threads.
+        self.result = None
+        self.generation = 0
+
+    def refresh(self):
+        metrics = list(self.collector.collect())
+        self.result = (metrics, self.clock())
+        self.generation += 1
+
+    def collect_cached(self):
+        result = self.result
+
+        if result is None:
+            # Not refreshed yet.
+            yield collector_up_gauge(self.metric_name_list, self.description, succeeded=False)
+        else:
+            yield from result[0]
+
+    def collect_uncached(self):
+        result = self.result
+
+        if result is not None:
+            yield collector_cache_age_gauge(self.metric_name_list, self.description,
+                                            self.clock() - result[1])
+
+    def collect(self):
+        yield from self.collect_cached()
+        yield from self.collect_uncached()
+
+
+class CoalescingCollector(object):
+    """
+    Shares the result of a wrapped collector between concurrent collect() calls.
+
+    If a collect() is already in progress, other callers wait for it to finish
+    and get the same metrics, rather than starting another fetch. Completed
+    results are also reused by callers within `window` seconds.
+    """
+
+    def __init__(self, collector, window=0, clock=time.monotonic):
+        self.metric_name_list = collector.metric_name_list
+        self.description = collector.description
+
+        self.collector = collector
+        self.window = window
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        # Future for the in progress or last completed collect.
+        self.future = None
+        self.completed_time = None
+
+    def collect(self):
+        with self.lock:
+            future = self.future
+            if future is None or \
+               (future.done() and self.clock() - self.completed_time >= self.window):
+                future = self.future = concurrent.futures.Future()
+                in_flight = False
+            else:
+                in_flight = True
+
+        if not in_flight:
+            try:
+                metrics = list(self.collector.collect())
+            except BaseException as e:
+                with self.lock:
+                    self.future = None
+                future.set_exception(e)
+                raise
+            else:
+                self.completed_time = self.clock()
+                future.set_result(metrics)
+
+        yield from future.result()
+
+
+def collect_list(collector):
+    return list(collector.collect())
+
+
+class ParallelCollector(object):
+    """
+    Collects from multiple collectors concurrently.
+
+    Each collect() call runs all the wrapped collectors at once, so it takes
+    about as long as the slowest of them rather than their total. Metrics are
+    yielded collector by collector, in the order the collectors finish.
+    """
+
+    def __init__(self, collectors):
+        self.collectors = collectors
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(collectors))
+
+    def collect(self):
+        futures = [self.executor.submit(collect_list, collector)
+                   for collector in self.collectors]
+
+        for future in concurrent.futures.as_completed(futures):
+            yield from future.result()
+
+
+class FormatCacheCollector(object):
+    """
+    Exports statistics for the metric name and label key formatting caches.
+    """
+
+    caches = {
+        'metric_name': format_metric_name,
+        'label_key': format_label_key,
+    }
+
+    def collect(self):
+        hits = CounterMetricFamily('es_exporter_format_cache_hits',
+                                   'Number of formatting cache hits.',
+                                   labels=['cache'])
+        misses = CounterMetricFamily('es_exporter_format_cache_misses',
+                                     'Number of formatting cache misses.',
+                                     labels=['cache'])
+        size = GaugeMetricFamily('es_exporter_format_cache_size',
+                                 'Number of entries in the formatting cache.',
+                                 labels=['cache'])
+
+        for cache, function in self.caches.items():
+            info = function.cache_info()
+            hits.add_metric([cache], info.hits)
+            misses.add_metric([cache], info.misses)
+            size.add_metric([cache], info.currsize)
+
+        yield hits
+        yield misses
+        yield size
+
+
+class BreakerCollector(object):
+    """
+    Exports the state and effective interval of circuit breakers.
+
+    Takes breakers as a dict of name -> CircuitBreaker.
+    """
+
+    def __init__(self, breakers):
+        self.breakers = breakers
+
+    def collect(self):
+        interval = GaugeMetricFamily('es_exporter_breaker_interval_seconds',
+                                     'Effective interval between runs, after any back-off.',
+                                     labels=['name'])
+        state = GaugeMetricFamily('es_exporter_breaker_state',
+                                  'Circuit breaker state (1 for the current state).',
+                                  labels=['name', 'state'])
+
+        for name, breaker in self.breakers.items():
+            interval.add_metric([name], breaker.interval)
+            for s in STATES:
+                state.add_metric([name, s], int(breaker.state == s))
+
+        yield interval
+        yield state
+
+
+class ThrottleCollector(object):
+    """
+    Exports the query concurrency limit set by a SearchThrottle.
+    """
+
+    def __init__(self, throttle):
+        self.throttle = throttle
+
+    def collect(self):
+        yield GaugeMetricFamily('es_exporter_query_concurrency_limit',
+                                'Number of queries allowed to run at once, after throttling '
+                                'for search thread pool pressure.',
+                                value=self.throttle.limit)
@@ -0,0 +1,172 @@
+import logging
+import struct
+import threading
+import zlib
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit
+
+from prometheus_client.exposition import CONTENT_TYPE_LATEST, generate_latest
+
+log = logging.getLogger(__name__)
+
+
+class CollectorOutput(object):
+    """
+    Adapts a collect function to the interface expected by generate_latest().
+    """
+
+    def __init__(self, collect):
+        self.collect = collect
+
+
+# Gzip header with no file name, modification time, etc.
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+# An empty, final, deflate block.
+DEFLATE_END = b'\x03\x00'
+
+
+def deflate(text):
+    """
+    Compresses text into deflate blocks that can be concatenated with others.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # A sync flush ends on a byte boundary without marking the final block.
+    return compressor.compress(text) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def render(collect):
+    text = generate_latest(CollectorOutput(collect))
+    if not text:
+        return b'', b''
+    return text, deflate(text)
+
+
+def gzip_join(parts):
+    """
+    Builds a single member gzip body from (text, deflated text) parts.
+
+    Only the checksum needs calculating over the whole text, which is much
+    cheaper than compressing it.
+    """
+    crc = 0
+    size = 0
+    for text, _ in parts:
+        crc = zlib.crc32(text, crc)
+        size += len(text)
+
+    deflated = [deflated for _, deflated in parts]
+    trailer = struct.pack('<II', crc & 0xffffffff, size & 0xffffffff)
+    return b''.join([GZIP_HEADER] + deflated + [DEFLATE_END, trailer])
+
+
+class CachedExposition(object):
+    """
+    Renders the exposition body for a list of collectors, caching what it can.
+
+    Collectors with a `generation` attribute are cacheable. The output of their
+    collect_cached() method is only rendered (and compressed) again when their
+    generation changes. The output of their collect_uncached() method, and of
+    any other collectors, is rendered on every call.
+    """
+
+    def __init__(self, collectors):
+        self.collectors = collectors
+        # Maps collector index -> (generation, text, deflated text).
+        # Entries are replaced wholesale, so they can be read from any thread.
+        self.cache = {}
+
+    def render_cached(self, index, collector):
+        # Read the generation before rendering, so any change made while
+        # rendering causes a re-render next time.
+        generation = collector.generation
+
+        cached = self.cache.get(index)
+        if cached is None or cached[0] != generation:
+            cached = (generation, *render(collector.collect_cached))
+            self.cache[index] = cached
+
+        return cached[1:]
+
+    def render(self):
+        """
+        Returns a list of (text, deflated text) tuples for the exposition body.
+        """
+        parts = []
+        for index, collector in enumerate(self.collectors):
+            if hasattr(collector, 'generation'):
+                parts.append(self.render_cached(index, collector))
+                parts.append(render(collector.collect_uncached))
+            else:
+                parts.append(render(collector.collect))
+
+        return parts
+
+
+# Paths metrics are served on. Other paths are not found.
+METRICS_PATHS = ('/', '/metrics')
+
+
+def make_handler(exposition):
+
+    class CachedMetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            self.serve_metrics(send_body=True)
+
+        def do_HEAD(self):
+            self.serve_metrics(send_body=False)
+
+        def serve_metrics(self, send_body):
+            path = urlsplit(self.path).path
+            if path not in METRICS_PATHS:
+                self.send_error(404)
+                return
+
+            try:
+                parts = exposition.render()
+            except Exception:
+                log.exception('Error while rendering metrics.')
+                self.send_error(500, 'Error rendering metrics.')
+                return
+
+            accept_encoding = self.headers.get('Accept-Encoding', '')
+            gzip_accepted = 'gzip' in accept_encoding.lower()
+            if gzip_accepted:
+                body = gzip_join(parts)
+            else:
+                body = b''.join(text for text, _ in parts)
+
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+            if gzip_accepted:
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Don't log every request.
+            pass
+
+    return CachedMetricsHandler
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_cached_http_server(port, collectors, addr=''):
+    """
+    Starts a HTTP server for the collectors' metrics in a daemon thread.
+
+    Unlike prometheus_client.start_http_server(), the rendered output of
+    cacheable collectors is cached (see CachedExposition).
+    """
+    exposition = CachedExposition(collectors)
+    httpd = ThreadingHTTPServer((addr, port), make_handler(exposition))
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
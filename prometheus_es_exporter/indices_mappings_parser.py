@@ -1,6 +1,6 @@
 from collections import OrderedDict
 
-from .metrics import format_metric_name, format_labels
+from .metrics import format_metrics
 from .utils import merge_dicts_ordered
 
 
@@ -10,44 +10,33 @@ def count_object_fields(object_mappings, counts=None):
     else:
         counts = counts.copy()
 
-    for field, mapping in object_mappings['properties'].items():
-        # This field is an object, so count its fields.
-        if 'properties' in mapping:
-            field_type = 'object'
-            if field_type in counts:
-                counts[field_type] += 1
-            else:
-                counts[field_type] = 1
+    # Walk nested objects with a stack, rather than recursing, so the counts
+    # can be updated in place.
+    pending = [object_mappings]
+    while pending:
+        for field, mapping in pending.pop()['properties'].items():
+            # This field is an object, so count its fields.
+            if 'properties' in mapping:
+                field_type = 'object'
+                counts[field_type] = counts.get(field_type, 0) + 1
 
-            counts = count_object_fields(mapping, counts=counts)
+                pending.append(mapping)
 
-        else:
-            field_type = mapping['type']
-            if field_type in counts:
-                counts[field_type] += 1
             else:
-                counts[field_type] = 1
-
-            # If a field has any multifields (copies of the field with different mappings) we need
-            # to add their mappings as well.
-            if 'fields' in mapping:
-                for mfield, mfield_mapping in mapping['fields'].items():
-                    mfield_type = mfield_mapping['type']
-                    if mfield_type in counts:
-                        counts[mfield_type] += 1
-                    else:
-                        counts[mfield_type] = 1
-
-    return counts
+                field_type = mapping['type']
+                counts[field_type] = counts.get(field_type, 0) + 1
 
+                # If a field has any multifields (copies of the field with different mappings) we
+                # need to add their mappings as well.
+                if 'fields' in mapping:
+                    for mfield, mfield_mapping in mapping['fields'].items():
+                        mfield_type = mfield_mapping['type']
+                        counts[mfield_type] = counts.get(mfield_type, 0) + 1
 
-def parse_index(index, mappings, metric=None):
-    if metric is None:
-        metric = []
+    return counts
 
-    metric = metric + ['field', 'count']
-    labels = OrderedDict([('index', index)])
 
+def count_index_fields(mappings):
     # In newer Elasticsearch versions, the mappings root is simply the object mappings for the whole
     # document, so we can count the fields in it directly.
     if 'properties' in mappings:
@@ -76,27 +65,40 @@ def parse_index(index, mappings, metric=None):
     else:
         counts = {}
 
-    metrics = []
+    return counts
+
+
+def parse_index_counts(index, counts, metric=None):
+    if metric is None:
+        metric = []
+
+    metric = metric + ['field', 'count']
+    labels = OrderedDict([('index', index)])
+
     for field_type, count in counts.items():
-        metrics.append((metric, '', merge_dicts_ordered(labels, field_type=field_type), count))
+        yield (metric, '', merge_dicts_ordered(labels, field_type=field_type), count)
 
-    return metrics
+
+def parse_index(index, mappings, metric=None):
+    return parse_index_counts(index, count_index_fields(mappings), metric=metric)
 
 
 def parse_response(response, metric=None):
     if metric is None:
         metric = []
 
-    metrics = []
-
     for index, data in response.items():
-        metrics.extend(parse_index(index, data['mappings'], metric=metric))
-
-    return [
-        (format_metric_name(*metric_name),
-         metric_doc,
-         format_labels(label_dict),
-         value)
-        for metric_name, metric_doc, label_dict, value
-        in metrics
-    ]
+        yield from format_metrics(parse_index(index, data['mappings'], metric=metric))
+
+
+def parse_counts(counts_by_index, metric=None):
+    """
+    Parses field counts previously calculated by count_index_fields().
+
+    Takes counts as a dict of index -> counts dict.
+    """
+    if metric is None:
+        metric = []
+
+    for index, counts in counts_by_index.items():
+        yield from format_metrics(parse_index_counts(index, counts, metric=metric))
@@ -1,6 +1,6 @@
 from collections import OrderedDict
 
-from .metrics import format_metric_name, format_labels
+from .metrics import format_metrics
 from .utils import merge_dicts_ordered
 
 singular_forms = {
@@ -19,14 +19,12 @@ def parse_block(block, metric=None, labels=None):
     if labels is None:
         labels = OrderedDict()
 
-    metrics = []
-
     for key, value in block.items():
         if key not in excluded_keys:
             if isinstance(value, bool):
-                metrics.append((metric + [key], '', labels, int(value)))
+                yield (metric + [key], '', labels, int(value))
             elif isinstance(value, (int, float)):
-                metrics.append((metric + [key], '', labels, value))
+                yield (metric + [key], '', labels, value)
             elif isinstance(value, dict):
                 if key in bucket_dict_keys:
                     if key in singular_forms:
@@ -34,37 +32,53 @@ def parse_block(block, metric=None, labels=None):
                     else:
                         singular_key = key
                     for n_key, n_value in value.items():
-                        metrics.extend(parse_block(n_value, metric=metric + [key], labels=merge_dicts_ordered(labels, {singular_key: [n_key]})))
+                        yield from parse_block(n_value, metric=metric + [key], labels=merge_dicts_ordered(labels, {singular_key: [n_key]}))
                 else:
-                    metrics.extend(parse_block(value, metric=metric + [key], labels=labels))
+                    yield from parse_block(value, metric=metric + [key], labels=labels)
             elif isinstance(value, list) and key in bucket_list_keys:
                 bucket_name_key = bucket_list_keys[key]
 
                 for n_value in value:
                     bucket_name = n_value[bucket_name_key]
-                    metrics.extend(parse_block(n_value, metric=metric + [key], labels=merge_dicts_ordered(labels, {bucket_name_key: [bucket_name]})))
+                    yield from parse_block(n_value, metric=metric + [key], labels=merge_dicts_ordered(labels, {bucket_name_key: [bucket_name]}))
+
+
+def plan_request(parse_indices=False, metrics=None):
+    """
+    Plans the smallest indices stats request that has everything parse_response() needs.
+
+    Only the cluster level (`_all`) stats are requested if per index stats won't be parsed,
+    and the response is filtered down to the parsed section, and the selected metric groups.
 
-    return metrics
+    Returns a dict of extra request params.
+    """
+    if parse_indices:
+        level = 'indices'
+        section = 'indices.*'
+    else:
+        level = 'cluster'
+        section = '_all'
+
+    if metrics:
+        # Each section has `primaries` and `total` stats for each metric group.
+        section_paths = ['{}.*.{}'.format(section, metric) for metric in metrics]
+    else:
+        section_paths = [section]
+
+    return {
+        'level': level,
+        'filter_path': ['_shards.failed'] + section_paths,
+    }
 
 
 def parse_response(response, parse_indices=False, metric=None):
     if metric is None:
         metric = []
 
-    metrics = []
-
     if '_shards' not in response or not response['_shards']['failed']:
+        # Sections may be missing from filtered responses if they are empty.
         if parse_indices:
-            for key, value in response['indices'].items():
-                metrics.extend(parse_block(value, metric=metric, labels=OrderedDict({'index': [key]})))
+            for key, value in response.get('indices', {}).items():
+                yield from format_metrics(parse_block(value, metric=metric, labels=OrderedDict({'index': [key]})))
         else:
-            metrics.extend(parse_block(response['_all'], metric=metric, labels=OrderedDict({'index': ['_all']})))
-
-    return [
-        (format_metric_name(*metric_name),
-         metric_doc,
-         format_labels(label_dict),
-         value)
-        for metric_name, metric_doc, label_dict, value
-        in metrics
-    ]
+            yield from format_metrics(parse_block(response.get('_all', {}), metric=metric, labels=OrderedDict({'index': ['_all']})))
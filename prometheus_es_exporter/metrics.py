@@ -1,25 +1,53 @@
-import re
+import functools
+import string
+import sys
 
 from collections import OrderedDict
 from prometheus_client.core import GaugeMetricFamily
 
 
-METRIC_INVALID_CHARS = re.compile(r'[^a-zA-Z0-9_:]')
-METRIC_INVALID_START_CHARS = re.compile(r'^[^a-zA-Z_:]')
-LABEL_INVALID_CHARS = re.compile(r'[^a-zA-Z0-9_]')
-LABEL_INVALID_START_CHARS = re.compile(r'^[^a-zA-Z_]')
-LABEL_START_DOUBLE_UNDER = re.compile(r'^__+')
+# The set of distinct metric names and label keys is small and stable, so
+# formatting them is cached. The caches are bounded in case it isn't.
+METRIC_NAME_CACHE_SIZE = 8192
+LABEL_KEY_CACHE_SIZE = 1024
 
 
+class SanitiseTable(dict):
+    """
+    str.translate() table replacing characters not in `allowed` with `_`.
+
+    Entries are added as characters are first seen, so the table covers any
+    character without having to enumerate them all up front.
+    """
+
+    def __init__(self, allowed):
+        super().__init__()
+        self.allowed = frozenset(ord(c) for c in allowed)
+
+    def __missing__(self, key):
+        value = key if key in self.allowed else '_'
+        self[key] = value
+        return value
+
+
+METRIC_TABLE = SanitiseTable(string.ascii_letters + string.digits + '_:')
+LABEL_TABLE = SanitiseTable(string.ascii_letters + string.digits + '_')
+
+
+@functools.lru_cache(maxsize=LABEL_KEY_CACHE_SIZE)
 def format_label_key(label_key):
     """
     Construct a label key.
 
     Disallowed characters are replaced with underscores.
     """
-    label_key = LABEL_INVALID_CHARS.sub('_', label_key)
-    label_key = LABEL_INVALID_START_CHARS.sub('_', label_key)
-    label_key = LABEL_START_DOUBLE_UNDER.sub('_', label_key)
+    label_key = label_key.translate(LABEL_TABLE)
+    # After translation, digits are the only disallowed start characters.
+    if label_key and label_key[0] in string.digits:
+        label_key = '_' + label_key[1:]
+    # Leading double underscores are reserved.
+    if label_key.startswith('__'):
+        label_key = '_' + label_key.lstrip('_')
     return label_key
 
 
@@ -58,6 +86,7 @@ def format_labels(label_dict):
     return formatted_label_dict
 
 
+@functools.lru_cache(maxsize=METRIC_NAME_CACHE_SIZE)
 def format_metric_name(*names):
     """
     Construct a metric name.
@@ -65,17 +94,62 @@ def format_metric_name(*names):
     If multiple name components are provided, they are joined by underscores.
     Disallowed characters are replaced with underscores.
     """
-    metric = '_'.join(names)
-    metric = METRIC_INVALID_CHARS.sub('_', metric)
-    metric = METRIC_INVALID_START_CHARS.sub('_', metric)
+    metric = '_'.join(names).translate(METRIC_TABLE)
+    if metric and metric[0] in string.digits:
+        metric = '_' + metric[1:]
     return metric
 
 
-def group_metrics(metrics):
+def format_metrics(metrics):
+    """
+    Formats a stream of metrics.
+
+    Takes metrics as an iterable of tuples containing:
+    * list of metric name components,
+    * metric documentation,
+    * dict of label key -> label value (or list of label value components),
+    * metric value.
+
+    Yields tuples with the metric name and labels formatted, suitable for
+    group_metrics(). Metrics are formatted one at a time as they're consumed,
+    so parsers that yield metrics as they walk a response never need to build
+    a full list of them.
+    """
+    # Parsers yield metrics sharing a label dict consecutively, so it's only
+    # formatted once (and the formatted dict stays shared for grouping).
+    last_label_dict = None
+    last_formatted = None
+
+    for metric_name, metric_doc, label_dict, value in metrics:
+        if label_dict is not last_label_dict:
+            last_label_dict = label_dict
+            last_formatted = format_labels(label_dict)
+
+        yield (format_metric_name(*metric_name),
+               metric_doc,
+               last_formatted,
+               value)
+
+
+class SeriesLimitExceeded(Exception):
+    """
+    Raised by group_metrics() when the metrics exceed the series limit.
+
+    The metrics grouped before the limit was reached are available as
+    `metric_dict`.
+    """
+
+    def __init__(self, metric_dict, max_series):
+        super().__init__('More than {} series.'.format(max_series))
+        self.metric_dict = metric_dict
+        self.max_series = max_series
+
+
+def group_metrics(metrics, metric_dict=None, max_series=None):
     """
     Groups metrics with the same name but different label values.
 
-    Takes metrics as a list of tuples containing:
+    Takes metrics as an iterable (e.g. a generator) of tuples containing:
     * metric name,
     * metric documentation,
     * dict of label key -> label value,
@@ -89,11 +163,40 @@ def group_metrics(metrics):
     * metric documentation
     * label keys tuple,
     * dict of label values tuple -> metric value.
+
+    If an existing metric dict is provided, the metrics are added to it (in
+    place) instead of a new one, e.g. to group the results of several requests.
+
+    If `max_series` is set, grouping stops as soon as a metric would add a
+    series (unique metric name and label values) beyond it, and
+    SeriesLimitExceeded is raised. Any remaining metrics aren't consumed, so a
+    lazy parser stops early too.
     """
 
-    metric_dict = {}
+    if metric_dict is None:
+        metric_dict = {}
+
+    series = None
+    if max_series is not None:
+        series = sum(len(value_dict) for _, _, value_dict in metric_dict.values())
+
+    # Many metrics have the same labels (e.g. every metric for a node or
+    # index), so one label keys tuple and label values tuple is shared between
+    # them, rather than each holding its own copy. Label value strings are
+    # interned, so they're also shared between runs.
+    shared_tuples = {}
+    # Parsers yield metrics sharing a label dict consecutively, so the tuples
+    # for the last label dict are reused directly.
+    last_label_dict = None
+    last_label_keys = None
+    last_label_values = None
+
     for (metric_name, metric_doc, label_dict, value) in metrics:
-        curr_label_keys = tuple(label_dict.keys())
+        if label_dict is last_label_dict:
+            curr_label_keys = last_label_keys
+        else:
+            curr_label_keys = tuple(label_dict.keys())
+            curr_label_keys = shared_tuples.setdefault(curr_label_keys, curr_label_keys)
 
         if metric_name in metric_dict:
             label_keys = metric_dict[metric_name][1]
@@ -104,9 +207,30 @@ def group_metrics(metrics):
             label_keys = curr_label_keys
             metric_dict[metric_name] = (metric_doc, label_keys, {})
 
-        label_values = tuple([label_dict[k] for k in label_keys])
-
-        metric_dict[metric_name][2][label_values] = value
+        if label_dict is last_label_dict and label_keys is last_label_keys:
+            label_values = last_label_values
+        else:
+            label_values = tuple([label_dict[k] for k in label_keys])
+            shared = shared_tuples.get(label_values)
+            if shared is None:
+                shared = tuple([sys.intern(v) for v in label_values])
+                shared_tuples[shared] = shared
+            label_values = shared
+
+            last_label_dict = label_dict
+            last_label_keys = label_keys
+            last_label_values = label_values
+
+        value_dict = metric_dict[metric_name][2]
+        if series is not None and label_values not in value_dict:
+            if series >= max_series:
+                # Don't leave a metric with no values behind.
+                if not value_dict:
+                    del metric_dict[metric_name]
+                raise SeriesLimitExceeded(metric_dict, max_series)
+            series += 1
+
+        value_dict[label_values] = value
 
     return metric_dict
 
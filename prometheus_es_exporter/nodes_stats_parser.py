@@ -1,6 +1,6 @@
 from collections import OrderedDict
 
-from .metrics import format_metric_name, format_labels
+from .metrics import format_metrics
 from .utils import merge_dicts_ordered
 
 singular_forms = {
@@ -23,20 +23,34 @@ bucket_list_keys = {
 }
 
 
-def parse_block(block, metric=None, labels=None):
+def child_filter(path_filter, key):
+    """
+    Returns the path filter for a key, or False if the key should be skipped.
+    """
+    if path_filter is None:
+        return None
+
+    return path_filter.child(key) or False
+
+
+def parse_block(block, metric=None, labels=None, path_filter=None):
     if metric is None:
         metric = []
     if labels is None:
         labels = OrderedDict()
 
-    metrics = []
-
     for key, value in block.items():
         if key not in excluded_keys:
+            key_filter = child_filter(path_filter, key)
+            if key_filter is False:
+                continue
+
             if isinstance(value, bool):
-                metrics.append((metric + [key], '', labels, int(value)))
+                if key_filter is None or key_filter.allowed:
+                    yield (metric + [key], '', labels, int(value))
             elif isinstance(value, (int, float)):
-                metrics.append((metric + [key], '', labels, value))
+                if key_filter is None or key_filter.allowed:
+                    yield (metric + [key], '', labels, value)
             elif isinstance(value, dict):
                 if key in bucket_dict_keys:
                     if key in singular_forms:
@@ -44,9 +58,13 @@ def parse_block(block, metric=None, labels=None):
                     else:
                         singular_key = key
                     for n_key, n_value in value.items():
-                        metrics.extend(parse_block(n_value, metric=metric + [key], labels=merge_dicts_ordered(labels, {singular_key: [n_key]})))
+                        # Bucket keys are part of the path, even though they become labels.
+                        n_key_filter = child_filter(key_filter, n_key)
+                        if n_key_filter is False:
+                            continue
+                        yield from parse_block(n_value, metric=metric + [key], labels=merge_dicts_ordered(labels, {singular_key: [n_key]}), path_filter=n_key_filter)
                 else:
-                    metrics.extend(parse_block(value, metric=metric + [key], labels=labels))
+                    yield from parse_block(value, metric=metric + [key], labels=labels, path_filter=key_filter)
             elif isinstance(value, list) and key in bucket_list_keys:
                 bucket_name_key = bucket_list_keys[key]
 
@@ -61,12 +79,11 @@ def parse_block(block, metric=None, labels=None):
                         # e.g. For AWS managed Elasticsearch instances, the `path` key is missing
                         #      from the filesystem `data` directory buckets.
                         bucket_name = str(n)
-                    metrics.extend(parse_block(n_value, metric=metric + [key], labels=merge_dicts_ordered(labels, {bucket_name_key: [bucket_name]})))
-
-    return metrics
+                    # List buckets aren't part of the path, matching `filter_path` behaviour.
+                    yield from parse_block(n_value, metric=metric + [key], labels=merge_dicts_ordered(labels, {bucket_name_key: [bucket_name]}), path_filter=key_filter)
 
 
-def parse_node(node, metric=None, labels=None):
+def parse_node(node, metric=None, labels=None, path_filter=None):
     if metric is None:
         metric = []
     if labels is None:
@@ -74,24 +91,19 @@ def parse_node(node, metric=None, labels=None):
 
     labels = merge_dicts_ordered(labels, node_name=[node['name']])
 
-    return parse_block(node, metric=metric, labels=labels)
+    return parse_block(node, metric=metric, labels=labels, path_filter=path_filter)
 
 
-def parse_response(response, metric=None):
+def parse_response(response, metric=None, path_filter=None):
+    """
+    Parses a nodes stats response.
+
+    If a PathFilter is provided, only metrics at allowed paths (relative to
+    each node's stats) are parsed.
+    """
     if metric is None:
         metric = []
 
-    metrics = []
-
     if '_nodes' not in response or not response['_nodes']['failed']:
         for key, value in response['nodes'].items():
-            metrics.extend(parse_node(value, metric=metric, labels=OrderedDict({'node_id': [key]})))
-
-    return [
-        (format_metric_name(*metric_name),
-         metric_doc,
-         format_labels(label_dict),
-         value)
-        for metric_name, metric_doc, label_dict, value
-        in metrics
-    ]
+            yield from format_metrics(parse_node(value, metric=metric, labels=OrderedDict({'node_id': [key]}), path_filter=path_filter))
@@ -1,120 +1,183 @@
 from collections import OrderedDict
 
-from .metrics import format_metric_name, format_labels
-
-
-def add_label(label_key, label_value, labels):
-    labels = labels.copy()
-
-    if label_key in labels.keys():
-        labels[label_key] = labels[label_key] + [label_value]
-    else:
-        labels[label_key] = [label_value]
-
-    return labels
-
+from .metrics import format_metrics
+
+
+def materialise_labels(labels):
+    """
+    Converts a label stack into a label dict.
+
+    Label stacks are linked tuples of (label key, label value, parent stack),
+    with None as the empty stack. Nested aggregations and buckets share their
+    parents' stacks rather than copying them, and stacks are only converted
+    when metrics are produced.
+
+    Label values are lists, as the same label key can be added multiple times
+    (e.g. by nested aggregations with the same name).
+    """
+    entries = []
+    while labels is not None:
+        label_key, label_value, labels = labels
+        entries.append((label_key, label_value))
+
+    label_dict = OrderedDict()
+    for label_key, label_value in reversed(entries):
+        if label_key in label_dict:
+            label_dict[label_key].append(label_value)
+        else:
+            label_dict[label_key] = [label_value]
 
-def parse_buckets(agg_key, buckets, metric=None, labels=None):
-    if metric is None:
-        metric = []
-    if labels is None:
-        labels = OrderedDict()
+    return label_dict
 
-    result = []
 
+def parse_buckets(agg_key, buckets, metric, labels):
     for index, bucket in enumerate(buckets):
-        labels_nest = labels.copy()
-
-        if 'key' in bucket.keys():
+        if 'key' in bucket:
             # Keys for composite aggregation buckets are dicts with multiple key/value pairs.
             if isinstance(bucket['key'], dict):
+                labels_nest = labels
                 for comp_key, comp_value in bucket['key'].items():
                     label_key = '_'.join([agg_key, comp_key])
-                    labels_nest = add_label(label_key, str(comp_value), labels_nest)
+                    labels_nest = (label_key, str(comp_value), labels_nest)
 
             else:
-                labels_nest = add_label(agg_key, str(bucket['key']), labels_nest)
-
-            # Delete the key so it isn't parsed for metrics.
-            del bucket['key']
+                labels_nest = (agg_key, str(bucket['key']), labels)
 
         else:
             bucket_key = 'filter_' + str(index)
-            labels_nest = add_label(agg_key, bucket_key, labels_nest)
+            labels_nest = (agg_key, bucket_key, labels)
 
-        result.extend(parse_agg(agg_key, bucket, metric=metric, labels=labels_nest))
+        # Skip the key so it isn't parsed for metrics.
+        yield from parse_agg(agg_key, bucket, metric, labels_nest, skip_key='key')
 
-    return result
-
-
-def parse_buckets_fixed(agg_key, buckets, metric=None, labels=None):
-    if metric is None:
-        metric = []
-    if labels is None:
-        labels = OrderedDict()
-
-    result = []
 
+def parse_buckets_fixed(agg_key, buckets, metric, labels):
     for bucket_key, bucket in buckets.items():
-        labels_nest = labels.copy()
-        labels_next = add_label(agg_key, bucket_key, labels_nest)
-        result.extend(parse_agg(agg_key, bucket, metric=metric, labels=labels_next))
+        yield from parse_agg(agg_key, bucket, metric, (agg_key, bucket_key, labels))
 
-    return result
 
+def parse_agg(agg_key, agg, metric, labels, skip_key=None):
+    """
+    Parses metrics from an aggregation result, yielding them as they're found.
 
-def parse_agg(agg_key, agg, metric=None, labels=None):
-    if metric is None:
-        metric = []
-    if labels is None:
-        labels = OrderedDict()
-
-    result = []
+    The aggregation result isn't modified. Labels are a label stack (see
+    materialise_labels()).
+    """
+    # Shared by all the metrics produced directly from this aggregation.
+    label_dict = None
 
     for key, value in agg.items():
-        if key == 'buckets' and isinstance(value, list):
-            result.extend(parse_buckets(agg_key, value, metric=metric, labels=labels))
+        if key == skip_key:
+            continue
+        elif key == 'buckets' and isinstance(value, list):
+            yield from parse_buckets(agg_key, value, metric, labels)
         elif key == 'buckets' and isinstance(value, dict):
-            result.extend(parse_buckets_fixed(agg_key, value, metric=metric, labels=labels))
+            yield from parse_buckets_fixed(agg_key, value, metric, labels)
         elif key == 'after_key' and 'buckets' in agg:
             # `after_key` is used for paging composite aggregations - don't parse for metrics.
             # https://www.elastic.co/guide/en/elasticsearch/reference/current/search-aggregations-bucket-composite-aggregation.html#_pagination
             continue
         elif isinstance(value, dict):
-            result.extend(parse_agg(key, value, metric=metric + [key], labels=labels))
+            yield from parse_agg(key, value, metric + [key], labels)
         # We only want numbers as metrics.
         # Anything else (with the exception of sub-objects,
         # which are handled above) is ignored.
         elif isinstance(value, (int, float)):
-            result.append((metric + [key], '', labels, value))
+            if label_dict is None:
+                label_dict = materialise_labels(labels)
+            yield (metric + [key], '', label_dict, value)
 
-    return result
+
+def set_composite_page_size(query, page_size):
+    """
+    Returns a copy of a query with the size of its top level composite
+    aggregations set to `page_size`.
+    """
+    aggs_key = 'aggregations' if 'aggregations' in query else 'aggs'
+    aggs = query.get(aggs_key, {})
+
+    next_aggs = {}
+    for key, agg in aggs.items():
+        if 'composite' in agg:
+            agg = dict(agg, composite=dict(agg['composite'], size=page_size))
+        next_aggs[key] = agg
+
+    return dict(query, **{aggs_key: next_aggs})
+
+
+# Composite aggregation page size used by Elasticsearch if none is given.
+DEFAULT_COMPOSITE_SIZE = 10
+
+
+def next_composite_query(query, response):
+    """
+    Builds the query for the next page of a query's top level composite
+    aggregations, from the `after_key`s in the response to the current page.
+
+    The query only includes the composite aggregations with more pages, and
+    doesn't fetch any hits. Returns None if there are no more pages, or if
+    the response timed out.
+    """
+    if response.get('timed_out'):
+        return None
+
+    aggs_key = 'aggregations' if 'aggregations' in query else 'aggs'
+    aggs = query.get(aggs_key, {})
+    aggregations = response.get('aggregations', {})
+
+    next_aggs = {}
+    for key, agg in aggs.items():
+        if 'composite' in agg and key in aggregations:
+            agg_result = aggregations[key]
+            # The last page has fewer buckets than the page size (possibly
+            # none), but may still have an `after_key`.
+            page_size = agg['composite'].get('size', DEFAULT_COMPOSITE_SIZE)
+            buckets = agg_result.get('buckets', [])
+            if agg_result.get('after_key') and len(buckets) >= page_size:
+                composite = dict(agg['composite'], after=agg_result['after_key'])
+                next_aggs[key] = dict(agg, composite=composite)
+
+    if not next_aggs:
+        return None
+
+    return dict(query, size=0, **{aggs_key: next_aggs})
+
+
+def parse_aggregations(aggregations, metric=None):
+    """
+    Parses the aggregations of a search response, yielding formatted metrics.
+
+    See parse_response().
+    """
+    if metric is None:
+        metric = []
+
+    for key, value in aggregations.items():
+        yield from format_metrics(parse_agg(key, value, metric + [key], None))
 
 
 def parse_response(response, metric=None):
+    """
+    Parses a search response, yielding formatted metrics.
+
+    Metrics are parsed and formatted as the response is walked, so consumers
+    that stop early (e.g. at a series limit) don't parse the rest of it.
+    """
     if metric is None:
         metric = []
 
-    metrics = []
-
-    if not response['timed_out']:
-        total = response['hits']['total']
-        # In ES7, hits.total changed from an integer to
-        # a dict with a 'value' key.
-        if isinstance(total, dict):
-            total = total['value']
-        metrics.append((metric + ['hits'], '', {}, total))
-        metrics.append((metric + ['took', 'milliseconds'], '', {}, response['took']))
-
-        if 'aggregations' in response.keys():
-            for key, value in response['aggregations'].items():
-                metrics.extend(parse_agg(key, value, metric=metric + [key]))
-
-    return [
-        (format_metric_name(*metric_name),
-         metric_doc,
-         format_labels(label_dict),
-         value)
-        for metric_name, metric_doc, label_dict, value
-        in metrics
-    ]
+    if response['timed_out']:
+        return
+
+    total = response['hits']['total']
+    # In ES7, hits.total changed from an integer to
+    # a dict with a 'value' key.
+    if isinstance(total, dict):
+        total = total['value']
+    yield from format_metrics([
+        (metric + ['hits'], '', {}, total),
+        (metric + ['took', 'milliseconds'], '', {}, response['took']),
+    ])
+
+    if 'aggregations' in response.keys():
+        yield from parse_aggregations(response['aggregations'], metric)
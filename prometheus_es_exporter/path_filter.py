@@ -0,0 +1,120 @@
+def compile_trie(patterns):
+    """
+    Compiles dotted path patterns into a trie of nested dicts.
+
+    Each dict maps keys to child dicts. A None key marks the end of a pattern.
+    """
+    root = {}
+    for pattern in patterns:
+        node = root
+        for key in pattern.split('.'):
+            node = node.setdefault(key, {})
+        node[None] = True
+
+    return root
+
+
+def next_nodes(nodes, key):
+    return [node[k] for node in nodes for k in (key, '*') if k in node]
+
+
+class PathFilter(object):
+    """
+    Matches paths through a response against allow and deny patterns.
+
+    Patterns are dotted paths of keys, where `*` matches any single key, e.g.
+    `jvm.mem`, or `thread_pool.*.rejected`. A pattern also matches everything
+    below the path it matches. Patterns prefixed with `!` deny paths, and take
+    precedence. If there are no allow patterns, all paths not denied are
+    allowed.
+
+    Paths are matched one key at a time using child(), which returns None as
+    soon as nothing at or below the path can be allowed, so whole subtrees can
+    be skipped.
+    """
+
+    def __init__(self, allow_nodes, deny_nodes, allowed):
+        self.allow_nodes = allow_nodes
+        self.deny_nodes = deny_nodes
+        # Whether the path so far (and so everything below it) is allowed.
+        self.allowed = allowed
+
+    @classmethod
+    def compile(cls, patterns):
+        allow_patterns = [p for p in patterns if not p.startswith('!')]
+        deny_patterns = [p[1:] for p in patterns if p.startswith('!')]
+
+        return cls([compile_trie(allow_patterns)],
+                   [compile_trie(deny_patterns)],
+                   allowed=not allow_patterns)
+
+    def child(self, key):
+        deny_nodes = next_nodes(self.deny_nodes, key)
+        if any(None in node for node in deny_nodes):
+            return None
+
+        if self.allowed:
+            return PathFilter((), deny_nodes, allowed=True)
+
+        allow_nodes = next_nodes(self.allow_nodes, key)
+        if not allow_nodes:
+            return None
+
+        allowed = any(None in node for node in allow_nodes)
+        return PathFilter(allow_nodes, deny_nodes, allowed=allowed)
+
+
+def bucket_name_paths(patterns, bucket_list_keys):
+    """
+    Returns paths to the keys naming the buckets of lists the patterns select
+    within.
+
+    `bucket_list_keys` maps list keys to the key naming each bucket in the
+    list. A `*` could be any list, so is given the paths of every bucket name
+    key.
+    """
+    paths = []
+    for pattern in patterns:
+        keys = pattern.split('.')
+        # A pattern matches everything below it, so bucket names are only
+        # missing if the pattern continues into the buckets.
+        for i, key in enumerate(keys[:-1]):
+            if key == '*':
+                name_keys = bucket_list_keys.values()
+            elif key in bucket_list_keys:
+                name_keys = [bucket_list_keys[key]]
+            else:
+                continue
+
+            for name_key in name_keys:
+                path = '.'.join(keys[:i + 1] + [name_key])
+                if path not in paths:
+                    paths.append(path)
+
+    return paths
+
+
+def to_filter_path(patterns, prefix, required=(), bucket_list_keys=None):
+    """
+    Converts allow patterns into an Elasticsearch `filter_path` param value.
+
+    The patterns are relative to `prefix`. Paths in `required` are always
+    included. Deny patterns aren't included, as `filter_path` exclusions aren't
+    supported by all Elasticsearch versions - they need to be applied to the
+    response instead.
+
+    If `bucket_list_keys` is given (see bucket_name_paths()), the keys naming
+    selected list buckets are included too, so buckets are labelled the same
+    as in unfiltered responses.
+
+    Returns None if there are no allow patterns (i.e. no filtering).
+    """
+    allow_patterns = [p for p in patterns if not p.startswith('!')]
+    if not allow_patterns:
+        return None
+
+    paths = list(allow_patterns)
+    if bucket_list_keys:
+        paths += bucket_name_paths(allow_patterns, bucket_list_keys)
+
+    return list(required) + ['{}.{}'.format(prefix, p) for p in paths]
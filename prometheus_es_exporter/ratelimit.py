@@ -0,0 +1,105 @@
+import asyncio
+import threading
+import time
+
+from elasticsearch import Transport
+from prometheus_client import Counter
+try:
+    # Requires the elasticsearch async extra (i.e. aiohttp).
+    from elasticsearch import AsyncTransport
+except ImportError:
+    AsyncTransport = None
+
+RATE_LIMITED_REQUESTS = Counter('es_exporter_rate_limited_requests',
+                                'Number of Elasticsearch requests delayed by the rate limiter.',
+                                ['budget'])
+RATE_LIMIT_WAIT = Counter('es_exporter_rate_limit_wait_seconds',
+                          'Time Elasticsearch requests spent waiting for the rate limiter, '
+                          'in seconds.',
+                          ['budget'])
+
+
+class TokenBucket(object):
+    """
+    Limits requests to `rate` per second, with bursts of up to `burst` requests.
+
+    reserve() takes a token, and returns how long to wait before making the
+    request. Tokens are reserved in the order requests arrive, so waiting
+    requests are served in turn. Safe to share between threads.
+    """
+
+    def __init__(self, name, rate, burst=None, clock=time.monotonic):
+        self.name = name
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.updated_time = clock()
+
+    def reserve(self):
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_time) * self.rate)
+            self.updated_time = now
+
+            # Tokens go negative while requests are waiting for them.
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            RATE_LIMITED_REQUESTS.labels(self.name).inc()
+            RATE_LIMIT_WAIT.labels(self.name).inc(wait)
+        return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+
+class RateLimitedTransport(Transport):
+    """
+    A Transport that waits for a TokenBucket before each request.
+
+    Pass it to the client as transport_class, with the bucket as rate_limiter.
+    The bucket is waited for as each connection is taken from the pool, so
+    retries of failed requests take tokens too.
+    """
+
+    def __init__(self, *args, rate_limiter=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limiter = rate_limiter
+
+    def get_connection(self):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        return super().get_connection()
+
+
+if AsyncTransport is not None:
+    class AsyncRateLimitedTransport(AsyncTransport):
+        """
+        Like RateLimitedTransport, but for AsyncElasticsearch clients.
+
+        AsyncTransport.get_connection() isn't a coroutine, so the bucket is
+        waited for once per request instead, and retries don't take tokens.
+        """
+
+        def __init__(self, *args, rate_limiter=None, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.rate_limiter = rate_limiter
+
+        async def perform_request(self, method, url, headers=None, params=None, body=None):
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire_async()
+            return await super().perform_request(method, url, headers=headers,
+                                                 params=params, body=body)
+else:
+    AsyncRateLimitedTransport = None
@@ -1,42 +1,222 @@
+import heapq
+import itertools
+import random
+import threading
 import time
 import logging
+import zlib
+
+from prometheus_client import Counter
 
 log = logging.getLogger(__name__)
 
+JOB_RUNS_SKIPPED = Counter('es_exporter_job_runs_skipped',
+                           'Number of scheduled job runs skipped as previous runs were still '
+                           'in progress.',
+                           ['name'])
+JOB_OVERRUNS = Counter('es_exporter_job_overruns',
+                       'Number of scheduled job runs that took longer than the job interval.',
+                       ['name'])
+JOB_RUNS_EXPIRED = Counter('es_exporter_job_runs_expired',
+                           'Number of scheduled job runs dropped as they could not start '
+                           'before their deadline.',
+                           ['name'])
+
+# Lower priorities run first.
+DEFAULT_PRIORITY = 10
+
 
-def schedule_job(scheduler, executor, interval, func, *args, **kwargs):
+class PriorityExecutor(object):
     """
-    Schedule a function to be run on a fixed interval.
+    Runs functions on a pool of worker threads, in priority order.
+
+    Unlike concurrent.futures.ThreadPoolExecutor, which runs functions in the
+    order they're submitted, pending functions are run lowest priority first,
+    then earliest deadline first. Functions still pending when their deadline
+    (a `clock` time) passes are dropped, rather than run late.
 
-    Works with schedulers from the stdlib sched module.
+    The number of functions running at once can be lowered below max_workers
+    with set_limit().
     """
 
-    def scheduled_run(scheduled_time, *args, **kwargs):
-        def run_func(func, *args, **kwargs):
+    def __init__(self, max_workers, clock=time.monotonic):
+        self.max_workers = max_workers
+        self.clock = clock
+        self.limit = max_workers
+        self.running = 0
+        # Heap of (priority, deadline, sequence, on expired, function, args, kwargs).
+        self.queue = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+        for _ in range(max_workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        self.submit_prioritised(DEFAULT_PRIORITY, None, None, fn, *args, **kwargs)
+
+    def submit_prioritised(self, priority, deadline, on_expired, fn, *args, **kwargs):
+        """
+        Submits a function to run with a priority and deadline (which may be None).
+
+        If the function is dropped, on_expired (if not None) is called instead.
+        """
+        if deadline is None:
+            deadline = float('inf')
+
+        with self.condition:
+            heapq.heappush(self.queue, (priority, deadline, next(self.sequence),
+                                        on_expired, fn, args, kwargs))
+            self.condition.notify()
+
+    def set_limit(self, limit):
+        """
+        Sets the number of functions that can run at once (up to max_workers).
+
+        Functions already running are left to finish.
+        """
+        with self.condition:
+            self.limit = max(1, min(limit, self.max_workers))
+            self.condition.notify_all()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.queue or self.running >= self.limit:
+                    self.condition.wait()
+
+                # Drop every expired function, not just those that reach the
+                # front of the queue, so low priority runs don't linger.
+                now = self.clock()
+                expired = [item for item in self.queue if item[1] < now]
+                if expired:
+                    self.queue = [item for item in self.queue if item[1] >= now]
+                    heapq.heapify(self.queue)
+                    item = None
+                else:
+                    item = heapq.heappop(self.queue)
+                    self.running += 1
+
+            if item is None:
+                for _, _, _, on_expired, _, _, _ in expired:
+                    if on_expired is not None:
+                        on_expired()
+                continue
+
+            _, _, _, _, fn, args, kwargs = item
             try:
-                func(*args, **kwargs)
+                fn(*args, **kwargs)
             except Exception:
-                log.exception('Error while running scheduled job.')
+                log.exception('Error while running submitted function.')
+            finally:
+                with self.condition:
+                    self.running -= 1
+                    self.condition.notify()
+
+
+def stagger_offset(name, interval):
+    """
+    Returns an offset for a job's first run, between 0 and the interval.
+
+    Offsets are derived from a hash of the job's name, so they're spread
+    across the interval, but stay the same between restarts.
+    """
+    return (zlib.crc32(name.encode('utf-8')) % 1000) / 1000 * interval
 
-        if executor is not None:
+
+def schedule_job(scheduler, executor, interval, func, *args, offset=0, jitter=0,
+                 name=None, max_concurrent_runs=None,
+                 priority=DEFAULT_PRIORITY, deadline=None, **kwargs):
+    """
+    Schedule a function to be run on a fixed interval.
+
+    The first run is delayed by `offset` seconds. Each run is delayed by up to
+    `jitter` seconds more, chosen at random. The delay doesn't shift later
+    runs, so the job keeps to its interval.
+
+    If `max_concurrent_runs` is set, a run is skipped if that many earlier
+    runs are still in progress, so a slow job can't fill the executor. If the
+    job has a name, skipped runs and runs that take longer than the interval
+    are counted in the es_exporter_job_* metrics.
+
+    Runs due at the same time are started lowest `priority` first. If the
+    executor is a PriorityExecutor, runs waiting for a worker are also ordered
+    by priority. If `deadline` is set, runs that can't start within that many
+    seconds of being due (including any jitter) are dropped.
+
+    Works with schedulers from the stdlib sched module. Times are taken from
+    the scheduler's time function, which should match a PriorityExecutor's
+    clock.
+    """
+    lock = threading.Lock()
+    running = 0
+
+    def enter(scheduled_time, *args, **kwargs):
+        run_time = scheduled_time
+        if jitter:
+            run_time += random.uniform(0, jitter)
+
+        scheduler.enterabs(time=run_time,
+                           priority=priority,
+                           action=scheduled_run,
+                           argument=(scheduled_time, run_time, *args),
+                           kwargs=kwargs)
+
+    def run_func(func, *args, **kwargs):
+        nonlocal running
+
+        start_time = scheduler.timefunc()
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            log.exception('Error while running scheduled job.')
+        finally:
+            with lock:
+                running -= 1
+            if name is not None and scheduler.timefunc() - start_time > interval:
+                JOB_OVERRUNS.labels(name).inc()
+
+    def expired():
+        nonlocal running
+
+        with lock:
+            running -= 1
+        log.debug('Dropping run of job %(name)s, as it missed its deadline.', {'name': name})
+        if name is not None:
+            JOB_RUNS_EXPIRED.labels(name).inc()
+
+    def scheduled_run(scheduled_time, run_time, *args, **kwargs):
+        nonlocal running
+
+        with lock:
+            skip = max_concurrent_runs is not None and running >= max_concurrent_runs
+            if not skip:
+                running += 1
+
+        if skip:
+            log.debug('Skipping run of job %(name)s, as %(running)s runs are still in progress.',
+                      {'name': name, 'running': running})
+            if name is not None:
+                JOB_RUNS_SKIPPED.labels(name).inc()
+        elif deadline is not None and scheduler.timefunc() > run_time + deadline:
+            # e.g. The scheduler was held up by other jobs.
+            expired()
+        elif isinstance(executor, PriorityExecutor):
+            deadline_time = run_time + deadline if deadline is not None else None
+            executor.submit_prioritised(priority, deadline_time, expired,
+                                        run_func, func, *args, **kwargs)
+        elif executor is not None:
             executor.submit(run_func, func, *args, **kwargs)
         else:
             run_func(func, *args, **kwargs)
 
-        current_time = time.monotonic()
+        current_time = scheduler.timefunc()
         next_scheduled_time = scheduled_time + interval
         while next_scheduled_time < current_time:
             next_scheduled_time += interval
 
-        scheduler.enterabs(time=next_scheduled_time,
-                           priority=1,
-                           action=scheduled_run,
-                           argument=(next_scheduled_time, *args),
-                           kwargs=kwargs)
+        enter(next_scheduled_time, *args, **kwargs)
 
-    next_scheduled_time = time.monotonic()
-    scheduler.enterabs(time=next_scheduled_time,
-                       priority=1,
-                       action=scheduled_run,
-                       argument=(next_scheduled_time, *args),
-                       kwargs=kwargs)
+    enter(scheduler.timefunc() + offset, *args, **kwargs)
@@ -0,0 +1,62 @@
+import json
+
+from elasticsearch.exceptions import SerializationError
+from elasticsearch.serializer import JSONSerializer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class LoadsSerializer(JSONSerializer):
+    """
+    JSON serializer that decodes responses with a given loads() function.
+
+    Requests are still encoded by the default serializer, as they're small.
+    """
+
+    def __init__(self, name, loads):
+        self.name = name
+        self._loads = loads
+
+    def loads(self, s):
+        try:
+            return self._loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+
+def available_serializers():
+    """
+    Returns a dict of the available JSON libraries -> their loads() functions,
+    fastest first.
+    """
+    serializers = {}
+    if orjson is not None:
+        serializers['orjson'] = orjson.loads
+    if ujson is not None:
+        serializers['ujson'] = ujson.loads
+    serializers['json'] = json.loads
+    return serializers
+
+
+def get_serializer(name='auto'):
+    """
+    Returns a serializer using the named JSON library to decode responses.
+
+    If the name is 'auto', the fastest available library is used.
+    Raises ValueError if the named library isn't available.
+    """
+    serializers = available_serializers()
+
+    if name == 'auto':
+        name = next(iter(serializers))
+    elif name not in serializers:
+        raise ValueError('JSON library {} is not available.'.format(name))
+
+    return LoadsSerializer(name, serializers[name])
@@ -0,0 +1,73 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+THREAD_POOL_COLUMNS = 'node_name,queue,rejected'
+
+
+class SearchThrottle(object):
+    """
+    Scales the number of queries run at once to search thread pool pressure.
+
+    poll() (or poll_async()) fetches the search thread pool stats of every
+    node, and sets the limit of the limiter queries run on (a PriorityExecutor
+    or PrioritySemaphore). If any node's search queue is longer than
+    `max_queue`, or has rejected searches since the last poll, the limit is
+    halved. Otherwise it's increased by one, up to `max_limit`. If the stats
+    can't be fetched, the cluster is assumed to be busy.
+    """
+
+    def __init__(self, limiter, max_limit, max_queue=0, timeout=10):
+        self.limiter = limiter
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+
+        self.limit = max_limit
+        # Rejected search counts at the last poll, by node name.
+        self.rejected = {}
+
+    def poll(self, es_client):
+        try:
+            rows = es_client.cat.thread_pool(thread_pool_patterns='search',
+                                             format='json', h=THREAD_POOL_COLUMNS,
+                                             request_timeout=self.timeout)
+        except Exception:
+            log.exception('Error while fetching search thread pool stats.')
+            rows = None
+
+        self.update(rows)
+
+    async def poll_async(self, es_client):
+        try:
+            rows = await es_client.cat.thread_pool(thread_pool_patterns='search',
+                                                   format='json', h=THREAD_POOL_COLUMNS,
+                                                   request_timeout=self.timeout)
+        except Exception:
+            log.exception('Error while fetching search thread pool stats.')
+            rows = None
+
+        self.update(rows)
+
+    def update(self, rows):
+        if rows is None:
+            busy = True
+        else:
+            rejected = {row['node_name']: int(row['rejected']) for row in rows}
+            queue = max((int(row['queue']) for row in rows), default=0)
+
+            # Counts can go down if a node restarts.
+            busy = queue > self.max_queue or any(
+                count > self.rejected.get(node, count) for node, count in rejected.items())
+            self.rejected = rejected
+
+        if busy:
+            limit = max(1, self.limit // 2)
+        else:
+            limit = min(self.max_limit, self.limit + 1)
+
+        if limit != self.limit:
+            log.info('Changing query concurrency limit from %(old)s to %(new)s.',
+                     {'old': self.limit, 'new': limit})
+            self.limit = limit
+            self.limiter.set_limit(limit)
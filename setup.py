@@ -38,6 +38,12 @@ setup(
         'jog',
         'prometheus-client >= 0.6.0',
     ],
+    extras_require={
+        # Faster decoding of large Elasticsearch responses.
+        'orjson': ['orjson'],
+        # The asyncio query engine.
+        'async': ['elasticsearch[async]'],
+    },
     entry_points={
         'console_scripts': [
             'prometheus-es-exporter=prometheus_es_exporter:main',
@@ -0,0 +1,151 @@
+import unittest
+from unittest import mock
+
+from prometheus_es_exporter import BREAKERS_BY_QUERY, handle_query_error, run_query
+from prometheus_es_exporter.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from tests.utils import FakeClock
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def breaker(self, **kwargs):
+        return CircuitBreaker('foo', 10, clock=self.clock.time, **kwargs)
+
+    def fail_run(self, breaker):
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+
+    def test_opens_after_threshold(self):
+        breaker = self.breaker(failure_threshold=2)
+
+        self.fail_run(breaker)
+        self.assertEqual((CLOSED, 10), (breaker.state, breaker.interval))
+        self.fail_run(breaker)
+        self.assertEqual((OPEN, 20), (breaker.state, breaker.interval))
+
+    def test_success_resets_failures(self):
+        breaker = self.breaker(failure_threshold=2)
+
+        self.fail_run(breaker)
+        self.assertTrue(breaker.allow())
+        breaker.record_success(0.1)
+        self.fail_run(breaker)
+        self.assertEqual(CLOSED, breaker.state)
+
+    def test_half_open_probe(self):
+        breaker = self.breaker()
+        self.fail_run(breaker)
+
+        # Runs are skipped until the back-off has passed (give or take half
+        # an interval for scheduling).
+        self.clock.now = 10
+        self.assertFalse(breaker.allow())
+        self.clock.now = 15
+        self.assertTrue(breaker.allow())
+        self.assertEqual(HALF_OPEN, breaker.state)
+        # Only one probe at a time.
+        self.assertFalse(breaker.allow())
+
+    def test_probe_succeeds(self):
+        breaker = self.breaker()
+        self.fail_run(breaker)
+
+        self.clock.now = 20
+        self.assertTrue(breaker.allow())
+        breaker.record_success(0.1)
+        self.assertEqual((CLOSED, 10), (breaker.state, breaker.interval))
+        self.assertTrue(breaker.allow())
+
+    def test_probe_fails_backoff_grows(self):
+        breaker = self.breaker(max_interval=50)
+        self.fail_run(breaker)
+
+        intervals = []
+        for _ in range(3):
+            self.clock.now += breaker.interval
+            self.fail_run(breaker)
+            intervals.append((breaker.state, breaker.interval))
+
+        self.assertEqual([(OPEN, 40), (OPEN, 50), (OPEN, 50)], intervals)
+
+    def test_slow_and_timed_out_runs_fail(self):
+        breaker = self.breaker(slow_secs=1)
+
+        self.assertTrue(breaker.allow())
+        breaker.record_success(2)
+        self.assertEqual(OPEN, breaker.state)
+
+        breaker = self.breaker()
+        self.assertTrue(breaker.allow())
+        breaker.record_success(None)
+        self.assertEqual(OPEN, breaker.state)
+
+
+class StubSearchClient(object):
+
+    def __init__(self, response):
+        self.response = response
+
+    def search(self, index=None, body=None, request_timeout=None):
+        return self.response
+
+
+class QueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker('foo', 10, clock=self.clock.time)
+        BREAKERS_BY_QUERY['foo'] = self.breaker
+
+    def tearDown(self):
+        BREAKERS_BY_QUERY.clear()
+
+    def test_timed_out_first_page(self):
+        query = {
+            'size': 0,
+            'aggs': {'c': {'composite': {'sources': [{'k': {'terms': {'field': 'k'}}}], 'size': 1}}},
+        }
+        response = {
+            'aggregations': {'c': {'after_key': {'k': 1}, 'buckets': [{'key': {'k': 1}, 'doc_count': 1}]}},
+            'hits': {'hits': [], 'total': {'relation': 'eq', 'value': 1}},
+            'timed_out': True,
+            'took': 1,
+        }
+        run_query(StubSearchClient(response), 'foo', '_all', query, 10, 'drop', 'drop')
+
+        self.assertEqual(OPEN, self.breaker.state)
+
+    def test_reraised_error(self):
+        class FakeAuth(object):
+            pass
+
+        class StubTransport(object):
+            kwargs = {'http_auth': FakeAuth()}
+
+        class StubClient(object):
+            transport = StubTransport()
+
+        error = Exception('Unauthorized')
+        error.status_code = 401
+
+        # Probe after a failure.
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.clock.now = 20
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(HALF_OPEN, self.breaker.state)
+
+        with mock.patch('prometheus_es_exporter.AWS4Auth', FakeAuth, create=True), \
+                self.assertLogs('prometheus_es_exporter', level='ERROR'), \
+                self.assertRaises(Exception):
+            handle_query_error(StubClient(), error, 'foo', '_all', {}, 'drop')
+
+        # The probe doesn't leave the breaker stuck half open.
+        self.assertEqual((OPEN, 40), (self.breaker.state, self.breaker.interval))
+
+
+if __name__ == '__main__':
+    unittest.main()
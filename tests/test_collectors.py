@@ -0,0 +1,189 @@
+import threading
+import unittest
+
+from prometheus_client.core import GaugeMetricFamily
+
+from prometheus_es_exporter.collectors import (BackgroundCollector, CoalescingCollector,
+                                               ParallelCollector, collector_up_gauge)
+from tests.utils import FakeClock
+
+
+class StubCollector(object):
+    """
+    Yields a gauge of the number of times it's been collected.
+    """
+
+    def __init__(self, name='foo'):
+        self.metric_name_list = [name]
+        self.description = name.capitalize()
+        self.collects = 0
+
+    def collect(self):
+        self.collects += 1
+        yield GaugeMetricFamily(self.metric_name_list[0] + '_collects', '', value=self.collects)
+
+
+class BlockingCollector(StubCollector):
+    """
+    A StubCollector whose collects wait until `release` is set.
+    """
+
+    def __init__(self, name='foo'):
+        super().__init__(name)
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def collect(self):
+        self.collects += 1
+        self.started.set()
+        self.release.wait(5)
+        yield GaugeMetricFamily(self.metric_name_list[0] + '_collects', '', value=self.collects)
+
+
+class FailingCollector(StubCollector):
+    """
+    A StubCollector whose first collect fails.
+    """
+
+    def collect(self):
+        if not self.collects:
+            self.collects += 1
+            raise RuntimeError('Collect failed.')
+        yield from super().collect()
+
+
+class BarrierCollector(StubCollector):
+    """
+    A StubCollector whose collects wait at a barrier, so they only finish if
+    enough of them run at once. Yields an up gauge too, like the cluster
+    collectors.
+    """
+
+    def __init__(self, name, barrier):
+        super().__init__(name)
+        self.barrier = barrier
+
+    def collect(self):
+        self.barrier.wait(5)
+        yield from super().collect()
+        yield collector_up_gauge(self.metric_name_list, self.description)
+
+
+def samples(metrics):
+    return {sample.name: sample.value for metric in metrics for sample in metric.samples}
+
+
+class BackgroundCollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.stub = StubCollector()
+        self.collector = BackgroundCollector(self.stub, clock=self.clock.time)
+
+    def test_not_refreshed(self):
+        self.assertEqual({'foo_up': 0}, samples(self.collector.collect()))
+        self.assertEqual(0, self.stub.collects)
+
+    def test_serves_cached_result(self):
+        self.collector.refresh()
+        self.clock.now = 5
+
+        # Scrapes don't collect from the wrapped collector.
+        for _ in range(2):
+            self.assertEqual({'foo_collects': 1, 'foo_cache_age_seconds': 5},
+                             samples(self.collector.collect()))
+        self.assertEqual(1, self.stub.collects)
+
+    def test_refresh_replaces_result(self):
+        self.collector.refresh()
+        generation = self.collector.generation
+        self.clock.now = 10
+        self.collector.refresh()
+        self.clock.now = 12
+
+        self.assertEqual({'foo_collects': 2, 'foo_cache_age_seconds': 2},
+                         samples(self.collector.collect()))
+        self.assertEqual(generation + 1, self.collector.generation)
+
+    def test_cached_and_uncached(self):
+        self.collector.refresh()
+
+        # The cache age isn't part of the cached result, e.g. for the
+        # exposition cache.
+        self.assertEqual({'foo_collects': 1}, samples(self.collector.collect_cached()))
+        self.assertEqual({'foo_cache_age_seconds': 0},
+                         samples(self.collector.collect_uncached()))
+
+
+class CoalescingCollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_concurrent_collects_share_fetch(self):
+        stub = BlockingCollector()
+        collector = CoalescingCollector(stub, clock=self.clock.time)
+        results = []
+
+        def scrape():
+            results.append(samples(collector.collect()))
+
+        threads = [threading.Thread(target=scrape) for _ in range(3)]
+        threads[0].start()
+        self.assertTrue(stub.started.wait(5))
+        for thread in threads[1:]:
+            thread.start()
+            thread.join(0.1)
+        # The other scrapes wait for the fetch in progress.
+        self.assertEqual(1, stub.collects)
+
+        stub.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual([{'foo_collects': 1}] * 3, results)
+        self.assertEqual(1, stub.collects)
+
+    def test_window(self):
+        stub = StubCollector()
+        collector = CoalescingCollector(stub, window=10, clock=self.clock.time)
+
+        self.assertEqual({'foo_collects': 1}, samples(collector.collect()))
+        self.clock.now = 9
+        self.assertEqual({'foo_collects': 1}, samples(collector.collect()))
+        self.clock.now = 10
+        self.assertEqual({'foo_collects': 2}, samples(collector.collect()))
+
+    def test_no_window(self):
+        stub = StubCollector()
+        collector = CoalescingCollector(stub, clock=self.clock.time)
+
+        self.assertEqual({'foo_collects': 1}, samples(collector.collect()))
+        self.assertEqual({'foo_collects': 2}, samples(collector.collect()))
+
+    def test_error_not_reused(self):
+        stub = FailingCollector()
+        collector = CoalescingCollector(stub, window=10, clock=self.clock.time)
+
+        with self.assertRaises(RuntimeError):
+            list(collector.collect())
+        # The next scrape tries again, even within the window.
+        self.assertEqual({'foo_collects': 2}, samples(collector.collect()))
+
+
+class ParallelCollectorTest(unittest.TestCase):
+
+    def test_collectors_run_concurrently(self):
+        names = ['foo', 'bar', 'baz']
+        barrier = threading.Barrier(len(names))
+        collector = ParallelCollector([BarrierCollector(name, barrier) for name in names])
+
+        # Run one after another, the collectors would break the barrier.
+        self.assertEqual({
+            'foo_collects': 1, 'foo_up': 1,
+            'bar_collects': 1, 'bar_up': 1,
+            'baz_collects': 1, 'baz_up': 1,
+        }, samples(collector.collect()))
+
+
+if __name__ == '__main__':
+    unittest.main()
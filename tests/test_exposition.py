@@ -0,0 +1,66 @@
+import gzip
+import http.client
+import threading
+import unittest
+
+from prometheus_client.core import GaugeMetricFamily
+
+from prometheus_es_exporter.exposition import (CachedExposition, ThreadingHTTPServer,
+                                               deflate, gzip_join, make_handler)
+
+
+class StaticCollector(object):
+
+    def collect(self):
+        yield GaugeMetricFamily('foo', 'Foo.', value=1)
+
+
+class Test(unittest.TestCase):
+
+    def test_gzip_join(self):
+        texts = [b'foo{bar="a"} 1.0\n', b'', b'baz 2.0\n' * 100]
+        parts = [(text, deflate(text) if text else b'') for text in texts]
+
+        result = gzip.decompress(gzip_join(parts))
+        self.assertEqual(b''.join(texts), result)
+
+    def test_gzip_join_empty(self):
+        result = gzip.decompress(gzip_join([]))
+        self.assertEqual(b'', result)
+
+    def request(self, method, path):
+        exposition = CachedExposition([StaticCollector()])
+        httpd = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(exposition))
+        thread = threading.Thread(target=httpd.serve_forever, kwargs={'poll_interval': 0.01})
+        thread.daemon = True
+        thread.start()
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1])
+            connection.request(method, path)
+            response = connection.getresponse()
+            return response.status, response.getheader('Content-Length'), response.read()
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+    def test_handler_paths(self):
+        for path in ['/', '/metrics', '/metrics?foo=bar']:
+            status, _, body = self.request('GET', path)
+            self.assertEqual(200, status)
+            self.assertIn(b'foo 1.0\n', body)
+
+        status, _, _ = self.request('GET', '/foo')
+        self.assertEqual(404, status)
+
+    def test_handler_head(self):
+        status, length, body = self.request('HEAD', '/metrics')
+        self.assertEqual(200, status)
+        self.assertGreater(int(length), 0)
+        self.assertEqual(b'', body)
+
+        status, _, _ = self.request('HEAD', '/foo')
+        self.assertEqual(404, status)
+
+
+if __name__ == '__main__':
+    unittest.main()
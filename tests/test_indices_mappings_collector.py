@@ -0,0 +1,106 @@
+import unittest
+
+from prometheus_es_exporter import IndicesMappingsCollector
+
+
+class StubIndices(object):
+
+    def __init__(self, mappings):
+        self.mappings = mappings
+        self.requested = []
+
+    def get_mapping(self, index=None, ignore_unavailable=False, request_timeout=None):
+        self.requested.append(index)
+        if index is None:
+            index = list(self.mappings)
+        return {
+            i: {'mappings': self.mappings[i]}
+            for i in index
+            if i in self.mappings
+        }
+
+
+class StubCluster(object):
+
+    def __init__(self):
+        self.indices = {}
+
+    def state(self, metric=None, filter_path=None, request_timeout=None):
+        return {'metadata': {'indices': {
+            index: {'mapping_version': version, 'settings': {'index': {'uuid': uuid}}}
+            for index, (uuid, version) in self.indices.items()
+        }}}
+
+
+class StubClient(object):
+
+    def __init__(self):
+        self.cluster = StubCluster()
+        self.indices = StubIndices({})
+
+    def set_index(self, index, uuid, version, fields):
+        self.cluster.indices[index] = (uuid, version)
+        self.indices.mappings[index] = {
+            'properties': {field: {'type': 'keyword'} for field in fields}
+        }
+
+    def delete_index(self, index):
+        del self.cluster.indices[index]
+        del self.indices.mappings[index]
+
+
+def field_counts(counts_by_index):
+    return {index: sum(counts.values()) for index, counts in counts_by_index.items()}
+
+
+class Test(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        self.client = StubClient()
+        self.client.set_index('a', 'uuid-a', 1, ['f1'])
+        self.client.set_index('b', 'uuid-b', 1, ['f1', 'f2'])
+        self.collector = IndicesMappingsCollector(self.client, 10, incremental=True)
+
+    def fetch(self):
+        self.client.indices.requested = []
+        return field_counts(self.collector.fetch_counts())
+
+    def test_first_fetch(self):
+        self.assertEqual({'a': 1, 'b': 2}, self.fetch())
+        # Nothing is cached, so everything is fetched at once.
+        self.assertEqual([None], self.client.indices.requested)
+
+    def test_unchanged_skipped(self):
+        self.fetch()
+        self.assertEqual({'a': 1, 'b': 2}, self.fetch())
+        self.assertEqual([], self.client.indices.requested)
+
+    def test_changed_fetched(self):
+        self.fetch()
+        self.client.set_index('b', 'uuid-b', 2, ['f1', 'f2', 'f3'])
+        self.client.set_index('c', 'uuid-c', 1, ['f1'])
+
+        self.assertEqual({'a': 1, 'b': 3, 'c': 1}, self.fetch())
+        self.assertEqual([['b', 'c']], self.client.indices.requested)
+
+    def test_removed_evicted(self):
+        self.fetch()
+        self.client.delete_index('a')
+
+        self.assertEqual({'b': 2}, self.fetch())
+        self.assertEqual([], self.client.indices.requested)
+        self.assertNotIn('a', self.collector.index_counts)
+
+    def test_recreated_fetched(self):
+        self.fetch()
+        # Recreated with the same name and mapping version.
+        self.client.delete_index('a')
+        self.client.set_index('a', 'uuid-a2', 1, ['f1', 'f2', 'f3'])
+
+        self.assertEqual({'a': 3, 'b': 2}, self.fetch())
+        self.assertEqual([['a']], self.client.indices.requested)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 import unittest
 
-from prometheus_es_exporter.indices_mappings_parser import parse_response
+from prometheus_es_exporter.indices_mappings_parser import (
+    count_index_fields, parse_counts, parse_response)
 from tests.utils import convert_result
 
 
@@ -159,6 +160,49 @@ class Test(unittest.TestCase):
         result = convert_result(parse_response(response))
         self.assertEqual(expected, result)
 
+    def test_counts(self):
+        mappings = {
+            "properties": {
+                "group1": {
+                    "type": "text",
+                    "fields": {
+                        "keyword": {
+                            "type": "keyword",
+                            "ignore_above": 256
+                        }
+                    }
+                },
+                "sub": {
+                    "properties": {
+                        "sub_val": {
+                            "type": "long"
+                        },
+                        "sub_sub": {
+                            "properties": {
+                                "sub_sub_val": {
+                                    "type": "long"
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+
+        expected = {
+            'field_count{index="foo",field_type="keyword"}': 1,
+            'field_count{index="foo",field_type="long"}': 2,
+            'field_count{index="foo",field_type="text"}': 1,
+            'field_count{index="foo",field_type="object"}': 2,
+            'field_count{index="bar",field_type="long"}': 3
+        }
+        counts_by_index = {
+            'foo': count_index_fields(mappings),
+            'bar': {'long': 3},
+        }
+        result = convert_result(parse_counts(counts_by_index))
+        self.assertEqual(expected, result)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,136 @@
+import unittest
+
+from elasticsearch.exceptions import ConnectionTimeout, NotFoundError, TransportError
+
+from prometheus_es_exporter import IndicesStatsCollector
+from prometheus_es_exporter.metrics import group_metrics
+from tests.utils import convert_metric_dict
+
+
+class StubIndices(object):
+
+    def __init__(self, listed, existing, failing=()):
+        # Indices returned by get_alias().
+        self.listed = listed
+        # Indices that still exist when their stats are fetched.
+        self.existing = existing
+        # Indices whose batch fails.
+        self.failing = failing
+        self.alias_params = None
+
+    def get_alias(self, index=None, request_timeout=None, **params):
+        self.alias_params = params
+        return {i: {'aliases': {}} for i in self.listed}
+
+    def stats(self, index=None, metric=None, fields=None, request_timeout=None,
+              ignore_unavailable=False, **params):
+        if index is None:
+            index = list(self.existing)
+        if any(i in self.failing for i in index):
+            raise TransportError(500, 'internal_server_error')
+        missing = [i for i in index if i not in self.existing]
+        if missing and not ignore_unavailable:
+            raise NotFoundError(404, 'index_not_found_exception')
+
+        return {
+            '_shards': {'failed': 0},
+            'indices': {
+                i: {'primaries': {'docs': {'count': self.existing[i]}}}
+                for i in index
+                if i in self.existing
+            },
+        }
+
+
+class SlowUnplannedIndices(StubIndices):
+    """
+    Times out fetching stats without a filter_path, i.e. unplanned.
+    """
+
+    def stats(self, index=None, **params):
+        if 'filter_path' not in params:
+            raise ConnectionTimeout('TIMEOUT', 'Read timed out', None)
+        return super().stats(index=index, **params)
+
+
+class StubClient(object):
+
+    def __init__(self, indices):
+        self.indices = indices
+
+
+class Test(unittest.TestCase):
+    maxDiff = None
+
+    def collect(self, indices):
+        collector = IndicesStatsCollector(StubClient(indices), 10, parse_indices=True,
+                                          batch_size=2, batch_workers=2)
+        metric_dict, batches, failed = collector.collect_batches()
+        return convert_metric_dict(metric_dict), batches, failed
+
+    def test_batches_merged(self):
+        indices = StubIndices(['a', 'b', 'c'], {'a': 1, 'b': 2, 'c': 3})
+        result, batches, failed = self.collect(indices)
+
+        self.assertEqual({
+            'es_indices_stats_primaries_docs_count{index="a"}': 1,
+            'es_indices_stats_primaries_docs_count{index="b"}': 2,
+            'es_indices_stats_primaries_docs_count{index="c"}': 3,
+        }, result)
+        self.assertEqual((2, 0), (batches, failed))
+        self.assertEqual({'expand_wildcards': 'open'}, indices.alias_params)
+
+    def test_deleted_index_ignored(self):
+        # b is deleted after the indices are listed.
+        indices = StubIndices(['a', 'b', 'c'], {'a': 1, 'c': 3})
+        result, batches, failed = self.collect(indices)
+
+        self.assertEqual({
+            'es_indices_stats_primaries_docs_count{index="a"}': 1,
+            'es_indices_stats_primaries_docs_count{index="c"}': 3,
+        }, result)
+        self.assertEqual((2, 0), (batches, failed))
+
+    def test_failed_batch(self):
+        indices = StubIndices(['a', 'b', 'c'], {'a': 1, 'b': 2, 'c': 3}, failing=['c'])
+        result, batches, failed = self.collect(indices)
+
+        self.assertEqual({
+            'es_indices_stats_primaries_docs_count{index="a"}': 1,
+            'es_indices_stats_primaries_docs_count{index="b"}': 2,
+        }, result)
+        self.assertEqual((2, 1), (batches, failed))
+
+    def test_plan_savings_logged(self):
+        indices = StubIndices(['a', 'b'], {'a': 1, 'b': 2})
+        collector = IndicesStatsCollector(StubClient(indices), 10, parse_indices=True)
+        planned_response = {'_shards': {'failed': 0}, 'indices': {}}
+
+        with self.assertLogs('prometheus_es_exporter', level='DEBUG') as logs:
+            collector.log_plan_savings(planned_response)
+
+        self.assertEqual(1, len(logs.output))
+        self.assertIn('bytes saved', logs.output[0])
+        self.assertFalse(collector.log_plan_size)
+
+    def test_plan_savings_error(self):
+        indices = SlowUnplannedIndices(['a', 'b'], {'a': 1, 'b': 2})
+        collector = IndicesStatsCollector(StubClient(indices), 10, parse_indices=True)
+
+        with self.assertLogs('prometheus_es_exporter', level='DEBUG') as logs:
+            result = convert_metric_dict(group_metrics(
+                (metric.name, metric.documentation, sample.labels, sample.value)
+                for metric in collector.collect()
+                for sample in metric.samples))
+
+        # The planned response is still used.
+        self.assertEqual({
+            'es_indices_stats_primaries_docs_count{index="a"}': 1,
+            'es_indices_stats_primaries_docs_count{index="b"}': 2,
+            'es_indices_stats_up': 1,
+        }, result)
+        self.assertIn('Error while fetching unplanned Indices Stats', '\n'.join(logs.output))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,6 @@
 import unittest
 
-from prometheus_es_exporter.indices_stats_parser import parse_response
+from prometheus_es_exporter.indices_stats_parser import parse_response, plan_request
 from tests.utils import convert_result
 
 
@@ -878,6 +878,32 @@ class Test(unittest.TestCase):
         result = convert_result(parse_response(self.response, parse_indices=True))
         self.assertEqual(expected, result)
 
+    def test_plan_request_cluster(self):
+        expected = {
+            'level': 'cluster',
+            'filter_path': ['_shards.failed', '_all.*.docs', '_all.*.store'],
+        }
+        self.assertEqual(expected, plan_request(parse_indices=False, metrics=['docs', 'store']))
+
+    def test_plan_request_indices(self):
+        expected = {
+            'level': 'indices',
+            'filter_path': ['_shards.failed', 'indices.*'],
+        }
+        self.assertEqual(expected, plan_request(parse_indices=True))
+
+    # Empty sections are dropped from responses filtered with `filter_path`.
+    def test_endpoint_indices_filtered_empty(self):
+        response = {
+            '_shards': {
+                'failed': 0
+            }
+        }
+
+        expected = {}
+        result = convert_result(parse_response(response, parse_indices=True))
+        self.assertEqual(expected, result)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,9 +1,37 @@
 import unittest
 
-from prometheus_es_exporter.nodes_stats_parser import parse_response
+from prometheus_es_exporter.nodes_stats_parser import bucket_list_keys, parse_response
+from prometheus_es_exporter.path_filter import PathFilter, to_filter_path
 from tests.utils import convert_result
 
 
+def apply_filter_path(value, paths):
+    """
+    Filters a response like Elasticsearch's `filter_path` param.
+
+    Takes paths as lists of keys. Returns None if nothing is left.
+    """
+    if any(not path for path in paths):
+        return value
+
+    if isinstance(value, list):
+        items = [apply_filter_path(item, paths) for item in value]
+        items = [item for item in items if item is not None]
+        return items or None
+
+    if isinstance(value, dict):
+        result = {}
+        for key, child in value.items():
+            child_paths = [path[1:] for path in paths if path[0] in (key, '*')]
+            if child_paths:
+                child = apply_filter_path(child, child_paths)
+                if child is not None:
+                    result[key] = child
+        return result or None
+
+    return None
+
+
 # Sample responses generated by querying the endpoint on a Elasticsearch
 # server populated with the following data (http command = Httpie utility):
 # > http -v POST localhost:9200/foo/_doc/1 val:=1 group1=a group2=a
@@ -776,6 +804,121 @@ class Test(unittest.TestCase):
         result = convert_result(parse_response(response))
         self.assertEqual(expected, result)
 
+    def test_endpoint_path_filter(self):
+        # (Response trimmed)
+        response = {
+            'nodes': {
+                'bRcKq5zUTAuwNf4qvnXzIQ': {
+                    'name': 'bRcKq5z',
+                    'jvm': {
+                        'uptime_in_millis': 14238,
+                        'mem': {
+                            'heap_used_in_bytes': 288048496,
+                            'heap_max_in_bytes': 1038876672,
+                        },
+                    },
+                    'thread_pool': {
+                        'search': {
+                            'threads': 0,
+                            'rejected': 0,
+                        },
+                        'write': {
+                            'threads': 1,
+                            'rejected': 2,
+                        },
+                    },
+                    'fs': {
+                        'data': [
+                            {
+                                'path': '/usr/share/elasticsearch/data/nodes/0',
+                                'total_in_bytes': 233134567424,
+                                'free_in_bytes': 92206276608,
+                            }
+                        ],
+                    },
+                }
+            }
+        }
+        paths = ['jvm.mem.*', 'thread_pool.*.rejected', '!thread_pool.write', 'fs.data.total_in_bytes']
+
+        expected = {
+            'jvm_mem_heap_used_in_bytes{node_id="bRcKq5zUTAuwNf4qvnXzIQ",node_name="bRcKq5z"}': 288048496,
+            'jvm_mem_heap_max_in_bytes{node_id="bRcKq5zUTAuwNf4qvnXzIQ",node_name="bRcKq5z"}': 1038876672,
+            'thread_pool_rejected{node_id="bRcKq5zUTAuwNf4qvnXzIQ",node_name="bRcKq5z",thread_pool="search"}': 0,
+            'fs_data_total_in_bytes{node_id="bRcKq5zUTAuwNf4qvnXzIQ",node_name="bRcKq5z",path="/usr/share/elasticsearch/data/nodes/0"}': 233134567424,
+        }
+        result = convert_result(parse_response(response, path_filter=PathFilter.compile(paths)))
+        self.assertEqual(expected, result)
+
+        expected_filter_path = [
+            '_nodes.failed',
+            'nodes.*.jvm.mem.*',
+            'nodes.*.thread_pool.*.rejected',
+            'nodes.*.fs.data.total_in_bytes',
+        ]
+        self.assertEqual(expected_filter_path,
+                         to_filter_path(paths, 'nodes.*', required=['_nodes.failed']))
+
+    # Filtering in Elasticsearch with the generated filter_path must give the
+    # same result as parsing the whole response.
+    def test_endpoint_filter_path_matches_unfiltered(self):
+        # (Response trimmed)
+        response = {
+            '_nodes': {
+                'failed': 0,
+            },
+            'nodes': {
+                'bRcKq5zUTAuwNf4qvnXzIQ': {
+                    'name': 'bRcKq5z',
+                    'jvm': {
+                        'mem': {
+                            'heap_used_in_bytes': 288048496,
+                            'heap_max_in_bytes': 1038876672,
+                        },
+                    },
+                    'fs': {
+                        'data': [
+                            {
+                                'path': '/usr/share/elasticsearch/data/nodes/0',
+                                'total_in_bytes': 233134567424,
+                                'free_in_bytes': 92206276608,
+                            },
+                            {
+                                'path': '/usr/share/elasticsearch/data/nodes/1',
+                                'total_in_bytes': 133134567424,
+                                'free_in_bytes': 12206276608,
+                            },
+                        ],
+                        'io_stats': {
+                            'devices': [
+                                {
+                                    'device_name': 'dm-0',
+                                    'operations': 22045,
+                                    'read_operations': 14349,
+                                },
+                            ],
+                        },
+                    },
+                }
+            }
+        }
+
+        for paths in [
+            ['fs.data.total_in_bytes', 'fs.io_stats.devices.operations'],
+            ['jvm.mem.heap_used_in_bytes', 'fs.*.*.operations'],
+            ['fs.data', '!fs.data.free_in_bytes'],
+        ]:
+            filter_path = to_filter_path(paths, 'nodes.*',
+                                         required=['_nodes.failed', 'nodes.*.name'],
+                                         bucket_list_keys=bucket_list_keys)
+            filtered_response = apply_filter_path(response, [p.split('.') for p in filter_path])
+
+            path_filter = PathFilter.compile(paths)
+            expected = convert_result(parse_response(response, path_filter=path_filter))
+            result = convert_result(parse_response(filtered_response, path_filter=path_filter))
+            self.assertTrue(expected)
+            self.assertEqual(expected, result)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,10 @@
+import copy
 import unittest
 
-from prometheus_es_exporter.parser import parse_response
-from tests.utils import convert_result
+from prometheus_es_exporter.metrics import SeriesLimitExceeded, group_metrics
+from prometheus_es_exporter.parser import (next_composite_query, parse_response,
+                                           set_composite_page_size)
+from tests.utils import convert_metric_dict, convert_result
 
 
 # Sample responses generated by running the provided queries on a Elasticsearch
@@ -716,6 +719,12 @@ class Test(unittest.TestCase):
             'val_terms_doc_count{val_terms="3"}': 1,
             'val_terms_val_sum_value{val_terms="3"}': 3.0
         }
+        original_response = copy.deepcopy(response)
+        result = convert_result(parse_response(response))
+        self.assertEqual(expected, result)
+
+        # The response isn't modified, so parsing it again gives the same result.
+        self.assertEqual(original_response, response)
         result = convert_result(parse_response(response))
         self.assertEqual(expected, result)
 
@@ -936,6 +945,141 @@ class Test(unittest.TestCase):
         result = convert_result(parse_response(response))
         self.assertEqual(expected, result)
 
+    def test_composite_next_page(self):
+        query = {
+            "size": 0,
+            "aggs": {
+                "group_comp": {
+                    "composite": {
+                        "sources": [
+                            {"group1": {"terms": {"field": "group1.keyword"}}}
+                        ]
+                    }
+                },
+                "val_sum": {
+                    "sum": {"field": "val"}
+                }
+            }
+        }
+        query = set_composite_page_size(query, 1)
+        self.assertEqual(1, query['aggs']['group_comp']['composite']['size'])
+
+        response = {
+            "aggregations": {
+                "group_comp": {
+                    "after_key": {"group1": "a"},
+                    "buckets": [
+                        {"key": {"group1": "a"}, "doc_count": 2}
+                    ]
+                },
+                "val_sum": {"value": 6.0}
+            },
+            "hits": {"hits": [], "total": {"relation": "eq", "value": 3}},
+            "timed_out": False,
+            "took": 1
+        }
+
+        # Only the composite aggregation is fetched again, after the last key.
+        expected = {
+            "size": 0,
+            "aggs": {
+                "group_comp": {
+                    "composite": {
+                        "sources": [
+                            {"group1": {"terms": {"field": "group1.keyword"}}}
+                        ],
+                        "size": 1,
+                        "after": {"group1": "a"}
+                    }
+                }
+            }
+        }
+        next_query = next_composite_query(query, response)
+        self.assertEqual(expected, next_query)
+
+        # The last page has no buckets.
+        response = {
+            "aggregations": {
+                "group_comp": {
+                    "after_key": {"group1": "b"},
+                    "buckets": []
+                }
+            },
+            "hits": {"hits": [], "total": {"relation": "eq", "value": 3}},
+            "timed_out": False,
+            "took": 1
+        }
+        self.assertIsNone(next_composite_query(next_query, response))
+
+    def test_composite_next_page_short(self):
+        query = {
+            "size": 0,
+            "aggs": {
+                "group_comp": {
+                    "composite": {
+                        "sources": [
+                            {"group1": {"terms": {"field": "group1.keyword"}}}
+                        ],
+                        "size": 2
+                    }
+                }
+            }
+        }
+
+        # A page with fewer buckets than the page size is the last.
+        response = {
+            "aggregations": {
+                "group_comp": {
+                    "after_key": {"group1": "a"},
+                    "buckets": [
+                        {"key": {"group1": "a"}, "doc_count": 2}
+                    ]
+                }
+            },
+            "hits": {"hits": [], "total": {"relation": "eq", "value": 3}},
+            "timed_out": False,
+            "took": 1
+        }
+        self.assertIsNone(next_composite_query(query, response))
+
+        # Timed out pages aren't followed.
+        response["aggregations"]["group_comp"]["buckets"].append(
+            {"key": {"group1": "b"}, "doc_count": 1})
+        self.assertIsNotNone(next_composite_query(query, response))
+        response["timed_out"] = True
+        self.assertIsNone(next_composite_query(query, response))
+
+    def test_max_series(self):
+        response = {
+            "aggregations": {
+                "group1_term": {
+                    "buckets": [
+                        {"key": "a", "doc_count": 2},
+                        {"key": "b", "doc_count": 1}
+                    ]
+                }
+            },
+            "hits": {"hits": [], "total": {"relation": "eq", "value": 3}},
+            "timed_out": False,
+            "took": 1
+        }
+
+        # Grouping stops at the first series over the limit.
+        metrics = parse_response(response)
+        with self.assertRaises(SeriesLimitExceeded) as cm:
+            group_metrics(metrics, max_series=3)
+        expected = {
+            'hits': 3,
+            'took_milliseconds': 1,
+            'group1_term_doc_count{group1_term="a"}': 2,
+        }
+        self.assertEqual(expected, convert_metric_dict(cm.exception.metric_dict))
+
+        # Metrics that fit in the limit are all grouped.
+        metrics = parse_response(response)
+        result = convert_metric_dict(group_metrics(metrics, max_series=4))
+        self.assertEqual(4, len(result))
+
     # Tests handling of disallowed characters in labels and metric names
     # The '-'s in the aggregation name aren't allowed in metric names or
     # label keys, so need to be substituted.
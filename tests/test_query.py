@@ -0,0 +1,319 @@
+import asyncio
+import unittest
+
+from elasticsearch.exceptions import ConnectionTimeout
+
+from prometheus_es_exporter import (METRICS_BY_QUERY, batch_queries, query_batch_steps,
+                                    query_steps, run_query_async, run_query_batch,
+                                    run_query_batch_async)
+from tests.utils import convert_metric_dict
+
+
+def query_config(interval, indices, priority=10, deadline=None):
+    query = {'size': 0, 'query': {'match_all': {}}}
+    return (interval, 10, indices, query, 'drop', 'drop', None, priority, deadline)
+
+
+def hits_response(hits):
+    return {
+        'hits': {'hits': [], 'total': {'relation': 'eq', 'value': hits}},
+        'timed_out': False,
+        'took': 1,
+    }
+
+
+class StubMsearchClient(object):
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def msearch(self, body=None, request_timeout=None):
+        self.requests.append(body)
+        return {'took': 1, 'responses': self.responses}
+
+
+class StubAsyncClient(object):
+    """
+    Like an AsyncElasticsearch client, returning (or raising) the given search
+    responses in turn.
+    """
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    async def search(self, index=None, body=None, request_timeout=None):
+        self.requests.append(body)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    async def msearch(self, body=None, request_timeout=None):
+        self.requests.append(body)
+        return {'took': 1, 'responses': self.responses.pop(0)}
+
+
+def run_async(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def composite_response(keys, after_key=None, timed_out=False):
+    aggregation = {
+        'buckets': [{'key': {'group1': key}, 'doc_count': 1} for key in keys]
+    }
+    if after_key is not None:
+        aggregation['after_key'] = {'group1': after_key}
+
+    return {
+        'aggregations': {'group_comp': aggregation},
+        'hits': {'hits': [], 'total': {'relation': 'eq', 'value': 5}},
+        'timed_out': timed_out,
+        'took': 100,
+    }
+
+
+class CountingList(list):
+    """
+    A list that counts how many of its items have been iterated over.
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.iterated = 0
+
+    def __iter__(self):
+        for item in super().__iter__():
+            self.iterated += 1
+            yield item
+
+
+def run_steps(steps, responses):
+    """
+    Runs query steps, sending it the responses in turn.
+
+    Returns a tuple of (requested bodies, query steps result).
+    """
+    requests = [next(steps)]
+    try:
+        for response in responses:
+            requests.append(steps.send(response))
+    except StopIteration as stop:
+        return requests, stop.value
+
+    raise AssertionError('Query steps made more requests than there are responses.')
+
+
+class Test(unittest.TestCase):
+    maxDiff = None
+
+    query = {
+        'size': 0,
+        'aggs': {
+            'group_comp': {
+                'composite': {
+                    'sources': [
+                        {'group1': {'terms': {'field': 'group1.keyword'}}}
+                    ],
+                    'size': 2
+                }
+            }
+        }
+    }
+
+    def test_pages(self):
+        steps = query_steps('foo', self.query)
+        requests, (metric_dict, took) = run_steps(steps, [
+            composite_response(['a', 'b'], after_key='b'),
+            composite_response(['c', 'd'], after_key='d'),
+            # The short last page ends paging, without an extra request.
+            composite_response(['e'], after_key='e'),
+        ])
+
+        self.assertEqual(3, len(requests))
+        self.assertEqual({'group1': 'd'}, requests[2]['aggs']['group_comp']['composite']['after'])
+        self.assertEqual({
+            'foo_hits': 5,
+            'foo_took_milliseconds': 100,
+            'foo_group_comp_doc_count{group_comp_group1="a"}': 1,
+            'foo_group_comp_doc_count{group_comp_group1="b"}': 1,
+            'foo_group_comp_doc_count{group_comp_group1="c"}': 1,
+            'foo_group_comp_doc_count{group_comp_group1="d"}': 1,
+            'foo_group_comp_doc_count{group_comp_group1="e"}': 1,
+        }, convert_metric_dict(metric_dict))
+        self.assertAlmostEqual(0.3, took)
+
+    def test_first_page_timed_out(self):
+        steps = query_steps('foo', self.query)
+        requests, (metric_dict, took) = run_steps(steps, [
+            composite_response(['a', 'b'], after_key='b', timed_out=True),
+        ])
+
+        self.assertEqual(1, len(requests))
+        self.assertEqual({}, metric_dict)
+        self.assertIsNone(took)
+
+    def test_max_series(self):
+        query = {'size': 0, 'aggs': {'group1_term': {'terms': {'field': 'group1.keyword'}}}}
+        buckets = CountingList({'key': str(i), 'doc_count': 1} for i in range(10000))
+        response = {
+            'aggregations': {'group1_term': {'buckets': buckets}},
+            'hits': {'hits': [], 'total': {'relation': 'eq', 'value': 10000}},
+            'timed_out': False,
+            'took': 1,
+        }
+
+        steps = query_steps('foo', query, max_series=10)
+        with self.assertLogs('prometheus_es_exporter', level='WARNING'):
+            _, (metric_dict, _) = run_steps(steps, [response])
+
+        self.assertEqual(10, len(convert_metric_dict(metric_dict)))
+        # Parsing stops at the limit, rather than after the whole response.
+        self.assertLess(buckets.iterated, 20)
+
+    def test_later_page_timed_out(self):
+        steps = query_steps('foo', self.query)
+        next(steps)
+        steps.send(composite_response(['a', 'b'], after_key='b'))
+
+        with self.assertRaises(RuntimeError):
+            steps.send(composite_response(['c', 'd'], after_key='d', timed_out=True))
+
+
+class BatchTest(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        METRICS_BY_QUERY.clear()
+
+    def tearDown(self):
+        METRICS_BY_QUERY.clear()
+
+    def test_batch_queries(self):
+        queries = {
+            'a': query_config(10, 'index_a'),
+            'b': query_config(10, 'index_b', deadline=5),
+            'c': query_config(10, 'index_a', deadline=2),
+            'd': query_config(30, 'index_a'),
+            'e': query_config(10, 'index_a', priority=1),
+        }
+        batches = batch_queries(queries, 2)
+
+        # Batches are grouped by interval and priority, not index.
+        self.assertEqual([
+            (10, 10, 5, ['a', 'b']),
+            (10, 10, 2, ['c']),
+            (30, 10, None, ['d']),
+            (10, 1, None, ['e']),
+        ], [
+            (interval, priority, deadline, [args[0] for args in batch])
+            for interval, priority, deadline, batch in batches
+        ])
+
+        # Each query keeps its own indices.
+        self.assertEqual(['index_a', 'index_b'], [args[1] for args in batches[0][3]])
+
+    def test_msearch_body(self):
+        queries = {
+            'a': query_config(10, 'index_a'),
+            'b': query_config(10, 'index_b'),
+        }
+        (_, _, _, batch), = batch_queries(queries, 2)
+
+        steps = query_batch_steps(None, batch)
+        body = next(steps)
+        self.assertEqual([
+            {'index': 'index_a'}, queries['a'][3],
+            {'index': 'index_b'}, queries['b'][3],
+        ], body)
+
+    def test_failed_item(self):
+        queries = {
+            'a': query_config(10, 'index_a'),
+            'b': query_config(10, 'index_b'),
+            'c': query_config(10, 'index_c'),
+        }
+        (_, _, _, batch), = batch_queries(queries, 3)
+
+        client = StubMsearchClient([
+            hits_response(1),
+            {'status': 404, 'error': {'type': 'index_not_found_exception'}},
+            hits_response(3),
+        ])
+        with self.assertLogs('prometheus_es_exporter', level='ERROR'):
+            run_query_batch(client, batch)
+
+        self.assertEqual(1, len(client.requests))
+        # The failed query's metrics are dropped (on_error = drop), without
+        # affecting the others.
+        self.assertEqual(['a', 'c'], sorted(METRICS_BY_QUERY))
+        self.assertEqual({'a_hits': 1, 'a_took_milliseconds': 1},
+                         convert_metric_dict(METRICS_BY_QUERY['a']))
+        self.assertEqual({'c_hits': 3, 'c_took_milliseconds': 1},
+                         convert_metric_dict(METRICS_BY_QUERY['c']))
+
+
+class AsyncTest(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        METRICS_BY_QUERY.clear()
+
+    def tearDown(self):
+        METRICS_BY_QUERY.clear()
+
+    def test_run_query(self):
+        client = StubAsyncClient([
+            composite_response(['a', 'b'], after_key='b'),
+            composite_response(['c'], after_key='c'),
+        ])
+        run_async(run_query_async(client, 'foo', 'index_a', Test.query, 10, 'drop', 'drop'))
+
+        self.assertEqual(2, len(client.requests))
+        self.assertEqual({
+            'foo_hits': 5,
+            'foo_took_milliseconds': 100,
+            'foo_group_comp_doc_count{group_comp_group1="a"}': 1,
+            'foo_group_comp_doc_count{group_comp_group1="b"}': 1,
+            'foo_group_comp_doc_count{group_comp_group1="c"}': 1,
+        }, convert_metric_dict(METRICS_BY_QUERY['foo']))
+
+    def test_run_query_error(self):
+        client = StubAsyncClient([
+            hits_response(1),
+            ConnectionTimeout('TIMEOUT', 'Read timed out', None),
+        ])
+        query = {'size': 0, 'query': {'match_all': {}}}
+        run_async(run_query_async(client, 'foo', 'index_a', query, 10, 'drop', 'drop'))
+        self.assertEqual({'foo_hits': 1, 'foo_took_milliseconds': 1},
+                         convert_metric_dict(METRICS_BY_QUERY['foo']))
+
+        # The error drops the query's metrics (on_error = drop).
+        with self.assertLogs('prometheus_es_exporter', level='WARNING'):
+            run_async(run_query_async(client, 'foo', 'index_a', query, 10, 'drop', 'drop'))
+        self.assertEqual({}, METRICS_BY_QUERY['foo'])
+
+    def test_run_query_batch(self):
+        queries = {
+            'a': query_config(10, 'index_a'),
+            'b': query_config(10, 'index_b'),
+        }
+        (_, _, _, batch), = batch_queries(queries, 2)
+
+        client = StubAsyncClient([[hits_response(1), hits_response(2)]])
+        run_async(run_query_batch_async(client, batch))
+
+        self.assertEqual(1, len(client.requests))
+        self.assertEqual({'a_hits': 1, 'a_took_milliseconds': 1},
+                         convert_metric_dict(METRICS_BY_QUERY['a']))
+        self.assertEqual({'b_hits': 2, 'b_took_milliseconds': 1},
+                         convert_metric_dict(METRICS_BY_QUERY['b']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+from unittest import mock
+
+from elasticsearch import Connection
+from elasticsearch.exceptions import ConnectionError
+
+from prometheus_es_exporter.ratelimit import RateLimitedTransport, TokenBucket
+from tests.utils import FakeClock
+
+
+class StubConnection(Connection):
+    """
+    Fails the first `failures` requests with a connection error.
+    """
+    failures = 0
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None,
+                        ignore=(), headers=None):
+        if StubConnection.failures:
+            StubConnection.failures -= 1
+            raise ConnectionError('N/A', 'Connection refused', None)
+        return 200, {}, '{}'
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def bucket(self, rate, burst=None):
+        return TokenBucket('foo', rate, burst, clock=self.clock.time)
+
+    def test_burst(self):
+        bucket = self.bucket(2, burst=3)
+        self.assertEqual([0, 0, 0, 0.5], [bucket.reserve() for _ in range(4)])
+
+    def test_default_burst(self):
+        # A second's worth of requests.
+        bucket = self.bucket(2)
+        self.assertEqual([0, 0, 0.5], [bucket.reserve() for _ in range(3)])
+        # At least one request.
+        bucket = self.bucket(0.5)
+        self.assertEqual([0, 2], [bucket.reserve() for _ in range(2)])
+
+    def test_waiting_requests_queue(self):
+        bucket = self.bucket(2, burst=1)
+        self.assertEqual([0, 0.5, 1, 1.5], [bucket.reserve() for _ in range(4)])
+
+    def test_refill(self):
+        bucket = self.bucket(2, burst=2)
+        bucket.reserve()
+        bucket.reserve()
+
+        self.clock.now = 0.5
+        self.assertEqual(0, bucket.reserve())
+        self.assertEqual(0.5, bucket.reserve())
+
+        # Tokens don't build up past the burst.
+        self.clock.now = 100
+        self.assertEqual([0, 0, 0.5], [bucket.reserve() for _ in range(3)])
+
+    def test_acquire_blocks(self):
+        bucket = self.bucket(2, burst=1)
+        with mock.patch('prometheus_es_exporter.ratelimit.time.sleep') as sleep:
+            bucket.acquire()
+            sleep.assert_not_called()
+            bucket.acquire()
+            sleep.assert_called_once_with(0.5)
+
+
+class TransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bucket = TokenBucket('foo', 1, burst=10, clock=self.clock.time)
+
+    def tearDown(self):
+        StubConnection.failures = 0
+
+    def perform_request(self):
+        transport = RateLimitedTransport([{}], connection_class=StubConnection,
+                                         max_retries=2, rate_limiter=self.bucket)
+        # Skip the product check.
+        transport._verified_elasticsearch = True
+        transport.perform_request('GET', '/')
+
+    def test_request_takes_token(self):
+        self.perform_request()
+        self.assertEqual(9, self.bucket.tokens)
+
+    def test_retries_take_tokens(self):
+        StubConnection.failures = 2
+        self.perform_request()
+        self.assertEqual(7, self.bucket.tokens)
+
+
+if __name__ == '__main__':
+    unittest.main()
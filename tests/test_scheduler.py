@@ -0,0 +1,263 @@
+import asyncio
+import sched
+import threading
+import unittest
+from unittest import mock
+
+from prometheus_client import REGISTRY
+
+from prometheus_es_exporter.async_scheduler import PrioritySemaphore, run_job, run_periodically
+from prometheus_es_exporter.scheduler import PriorityExecutor, schedule_job
+from tests.utils import FakeClock
+
+
+def run_scheduler(scheduler, clock, until):
+    """
+    Runs scheduled events due up to a time on the fake clock.
+    """
+    while True:
+        delay = scheduler.run(blocking=False)
+        if delay is None or clock.now + delay > until:
+            break
+        clock.sleep(delay)
+
+
+class PriorityExecutorTest(unittest.TestCase):
+
+    def run_blocked(self, executor, submit):
+        """
+        Submits functions while the executor's single worker is busy, then
+        waits for them to run. Returns the results, in the order they ran.
+        """
+        results = []
+        blocking = threading.Event()
+        done = threading.Event()
+
+        executor.submit(blocking.wait)
+        submit(results.append)
+        # Runs last, as nothing has a lower priority.
+        executor.submit_prioritised(float('inf'), None, None, done.set)
+
+        blocking.set()
+        self.assertTrue(done.wait(5))
+        return results
+
+    def test_priority_order(self):
+        executor = PriorityExecutor(1, clock=FakeClock().time)
+
+        def submit(fn):
+            executor.submit_prioritised(20, None, None, fn, 'low')
+            executor.submit_prioritised(1, None, None, fn, 'high')
+            executor.submit_prioritised(10, 5, None, fn, 'medium, later deadline')
+            executor.submit_prioritised(10, 3, None, fn, 'medium, earlier deadline')
+
+        self.assertEqual(['high', 'medium, earlier deadline', 'medium, later deadline', 'low'],
+                         self.run_blocked(executor, submit))
+
+    def test_expired_dropped(self):
+        clock = FakeClock()
+        executor = PriorityExecutor(1, clock=clock.time)
+
+        def submit(fn):
+            on_expired = lambda: fn('expired')  # noqa: E731
+            executor.submit_prioritised(1, 5, on_expired, fn, 'high')
+            executor.submit_prioritised(20, 2, on_expired, fn, 'low')
+            executor.submit_prioritised(20, 10, on_expired, fn, 'low, later deadline')
+            # Both deadlines pass while the worker is busy.
+            clock.now = 6
+
+        self.assertEqual(['expired', 'expired', 'low, later deadline'],
+                         self.run_blocked(executor, submit))
+
+    def test_limit(self):
+        executor = PriorityExecutor(4)
+        executor.set_limit(2)
+        self.assertEqual(2, executor.limit)
+        executor.set_limit(10)
+        self.assertEqual(4, executor.limit)
+        executor.set_limit(0)
+        self.assertEqual(1, executor.limit)
+
+
+class ScheduleJobTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = sched.scheduler(self.clock.time, self.clock.sleep)
+        self.runs = []
+
+    def job(self, name, duration=0):
+        self.runs.append((name, self.clock.now))
+        self.clock.sleep(duration)
+
+    def test_priority_order(self):
+        schedule_job(self.scheduler, None, 10, self.job, 'low', priority=20)
+        schedule_job(self.scheduler, None, 10, self.job, 'high', priority=1)
+
+        run_scheduler(self.scheduler, self.clock, until=15)
+        self.assertEqual([('high', 0), ('low', 0), ('high', 10), ('low', 10)], self.runs)
+
+    def test_deadline(self):
+        # The high priority job holds up the scheduler for longer than the
+        # low priority job's deadline.
+        schedule_job(self.scheduler, None, 10, self.job, 'high', 3, priority=1)
+        schedule_job(self.scheduler, None, 10, self.job, 'low', priority=20, deadline=2)
+        schedule_job(self.scheduler, None, 10, self.job, 'low, no deadline', priority=20)
+
+        run_scheduler(self.scheduler, self.clock, until=5)
+        self.assertEqual([('high', 0), ('low, no deadline', 3)], self.runs)
+
+    def test_deadline_after_jitter(self):
+        # The jitter is longer than the deadline, but the scheduler is idle.
+        with mock.patch('prometheus_es_exporter.scheduler.random.uniform', return_value=5):
+            schedule_job(self.scheduler, None, 10, self.job, 'job', jitter=5, deadline=2)
+            run_scheduler(self.scheduler, self.clock, until=30)
+
+        self.assertEqual([('job', 5), ('job', 15), ('job', 25)], self.runs)
+
+
+class PrioritySemaphoreTest(unittest.TestCase):
+
+    def run_async(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_priority_order(self):
+        async def test():
+            semaphore = PrioritySemaphore(1)
+            order = []
+
+            async def waiter(name, priority, deadline=None):
+                await semaphore.acquire(priority, deadline)
+                order.append(name)
+                semaphore.release()
+
+            await semaphore.acquire()
+            tasks = [
+                asyncio.ensure_future(waiter('low', 20)),
+                asyncio.ensure_future(waiter('high', 1)),
+                asyncio.ensure_future(waiter('medium, later deadline', 10, 5)),
+                asyncio.ensure_future(waiter('medium, earlier deadline', 10, 3)),
+            ]
+            # Let the waiters queue up.
+            await asyncio.sleep(0)
+            semaphore.release()
+            await asyncio.gather(*tasks)
+            return order
+
+        self.assertEqual(['high', 'medium, earlier deadline', 'medium, later deadline', 'low'],
+                         self.run_async(test()))
+
+    def test_expired_dropped(self):
+        async def test():
+            loop = asyncio.get_event_loop()
+            semaphore = PrioritySemaphore(1)
+            runs = []
+
+            async def job(name):
+                runs.append(name)
+
+            await semaphore.acquire()
+            deadline_time = loop.time() + 0.01
+            tasks = [
+                asyncio.ensure_future(run_job(semaphore, 'high', 1, None, job, 'high')),
+                asyncio.ensure_future(run_job(semaphore, 'low', 20, deadline_time, job, 'low')),
+            ]
+            # The low priority job's deadline passes while it waits.
+            await asyncio.sleep(0.02)
+            semaphore.release()
+            await asyncio.gather(*tasks)
+            return runs, semaphore.held
+
+        self.assertEqual((['high'], 0), self.run_async(test()))
+
+    def test_limit(self):
+        async def test():
+            semaphore = PrioritySemaphore(1)
+            acquired = []
+
+            async def waiter(name):
+                await semaphore.acquire()
+                acquired.append(name)
+
+            await semaphore.acquire()
+            tasks = [asyncio.ensure_future(waiter(name)) for name in ['a', 'b']]
+            await asyncio.sleep(0)
+            self.assertEqual([], acquired)
+
+            # Raising the limit wakes waiters without a release.
+            semaphore.set_limit(3)
+            await asyncio.gather(*tasks)
+            return acquired, semaphore.held
+
+        self.assertEqual((['a', 'b'], 3), self.run_async(test()))
+
+
+class RunPeriodicallyTest(unittest.TestCase):
+
+    def run_for(self, secs, interval, duration=0, **kwargs):
+        """
+        Runs a job taking `duration` seconds with run_periodically() for a
+        while, returning the loop times of its runs (relative to the start).
+        """
+        loop = asyncio.new_event_loop()
+        start_time = loop.time()
+        runs = []
+
+        async def job():
+            runs.append(loop.time() - start_time)
+            await asyncio.sleep(duration)
+
+        loop.create_task(run_periodically(interval, job, **kwargs))
+        try:
+            loop.run_until_complete(asyncio.sleep(secs))
+        finally:
+            # Including any runs still in progress.
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.close()
+        return runs
+
+    def sample(self, metric, name):
+        return REGISTRY.get_sample_value(metric, {'name': name}) or 0
+
+    def test_offset(self):
+        runs = self.run_for(0.2, 0.1, offset=0.05)
+
+        self.assertEqual(2, len(runs))
+        self.assertGreaterEqual(runs[0], 0.05)
+
+    def test_skip(self):
+        before = self.sample('es_exporter_job_runs_skipped_total', 'skip_test')
+        # Runs at 0 and 0.3, skipping those due while the first is in progress.
+        runs = self.run_for(0.35, 0.1, duration=0.25, name='skip_test', max_concurrent_runs=1)
+
+        self.assertEqual(2, len(runs))
+        self.assertEqual(2, self.sample('es_exporter_job_runs_skipped_total', 'skip_test') - before)
+
+    def test_overrun(self):
+        before = self.sample('es_exporter_job_overruns_total', 'overrun_test')
+        # Runs at 0, 0.2 and 0.4 (which is still in progress at the end).
+        # Runs aren't skipped without max_concurrent_runs.
+        runs = self.run_for(0.55, 0.2, duration=0.3, name='overrun_test')
+
+        self.assertEqual(3, len(runs))
+        self.assertEqual(2, self.sample('es_exporter_job_overruns_total', 'overrun_test') - before)
+
+    def test_deadline_after_jitter(self):
+        # The jitter is longer than the deadline, but the loop is idle.
+        with mock.patch('prometheus_es_exporter.async_scheduler.random.uniform',
+                        return_value=0.05):
+            runs = self.run_for(0.3, 0.1, jitter=0.05, deadline=0.02)
+
+        self.assertEqual(3, len(runs))
+        self.assertGreaterEqual(runs[0], 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
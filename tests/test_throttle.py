@@ -0,0 +1,72 @@
+import unittest
+
+from prometheus_es_exporter.collectors import ThrottleCollector
+from prometheus_es_exporter.throttle import SearchThrottle
+
+
+class StubLimiter(object):
+
+    def __init__(self):
+        self.limits = []
+
+    def set_limit(self, limit):
+        self.limits.append(limit)
+
+
+def rows(queue=0, rejected=0, node='node1'):
+    return [{'node_name': node, 'queue': str(queue), 'rejected': str(rejected)}]
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = StubLimiter()
+        self.throttle = SearchThrottle(self.limiter, 8, max_queue=5)
+
+    def update(self, *rows_list):
+        for r in rows_list:
+            self.throttle.update(r)
+        return self.limiter.limits
+
+    def test_queue_halves_limit(self):
+        self.assertEqual([4, 2], self.update(rows(queue=6), rows(queue=10)))
+
+    def test_queue_within_max(self):
+        self.assertEqual([], self.update(rows(queue=5)))
+
+    def test_limit_floor(self):
+        self.assertEqual([4, 2, 1], self.update(*[rows(queue=6)] * 5))
+        self.assertEqual(1, self.throttle.limit)
+
+    def test_increase_to_ceiling(self):
+        self.update(rows(queue=6), rows(queue=6))
+        self.assertEqual([4, 2, 3, 4, 5, 6, 7, 8], self.update(*[rows()] * 8))
+        self.assertEqual(8, self.throttle.limit)
+
+    def test_rejected_increase(self):
+        # The first poll only records the rejected count.
+        self.assertEqual([], self.update(rows(rejected=3)))
+        self.assertEqual([4], self.update(rows(rejected=4)))
+        # No new rejections.
+        self.assertEqual([4, 5], self.update(rows(rejected=4)))
+
+    def test_rejected_count_reset(self):
+        # e.g. The node restarted.
+        self.assertEqual([], self.update(rows(rejected=3), rows(rejected=0)))
+
+    def test_rejected_by_node(self):
+        both = rows(rejected=3) + rows(rejected=7, node='node2')
+        self.assertEqual([], self.update(both, both))
+
+    def test_none_is_busy(self):
+        self.assertEqual([4], self.update(None))
+
+    def test_collector(self):
+        self.update(rows(queue=6))
+        metric, = ThrottleCollector(self.throttle).collect()
+        self.assertEqual([('es_exporter_query_concurrency_limit', 4)],
+                         [(sample.name, sample.value) for sample in metric.samples])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,21 @@
 from prometheus_es_exporter.metrics import group_metrics
 
 
+class FakeClock(object):
+    """
+    A clock for tests, which only moves when told to (or when slept on).
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now += secs
+
+
 def format_label(key, value):
     return key + '="' + value + '"'
 